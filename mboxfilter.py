@@ -1,20 +1,50 @@
 """
 Filter and sort mails from mboxes for archiving and reporting
 """
+import binascii
+import collections
+import datetime
 import email
 import email.generator
+import email.parser
 import getopt
+import gzip
 import hashlib
+import io
+import itertools
+import json
+import math
 import mailbox
+import mmap
+import multiprocessing
 import os
+import pickle
+import queue
+import quopri
 import re
 import sqlite3
 import sys
+import tempfile
+import threading
 import time
-#import traceback # todo remove
+import traceback
+import zlib
+
+try:
+	import bz2
+except ImportError:
+	bz2 = None
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+try:
+	import lzma
+except ImportError:
+	lzma = None
 
 # Actual version:
-__version__ = "0.1.6"
+__version__ = "0.1.7"
 
 # Header fields containing email addresses:
 HEADER_ADDRESS_FIELDS = ["From", "Cc", "Bc", "To", "Sender", "Reply-to"]
@@ -47,6 +77,114 @@ DEFAULT_QUIET = False
 DEFAULT_SEPARATOR = "."
 # Or logic for filter
 DEFAULT_FILTER_OR_LOGIC = False
+# Maximum number of result mboxes kept open (default):
+DEFAULT_MAX_OPEN = 128
+# Write buffer size of result mboxes in bytes (default):
+DEFAULT_BUFFERING = 1024 * 1024
+# Commit index rows after this number of mails (default):
+DEFAULT_INDEX_BATCH = 1000
+# Commit index rows after this number of seconds (default):
+DEFAULT_INDEX_INTERVAL = 5.0
+# Journal mode of the index db, None keeps the SQLite default (default):
+DEFAULT_JOURNAL_MODE = "WAL"
+# Synchronous mode of the index db, None keeps the SQLite default (default):
+DEFAULT_SYNCHRONOUS = "NORMAL"
+# Read mboxes by "mailbox" or "mmap" (default):
+DEFAULT_READER = "mailbox"
+# Release mapped pages of a mbox after reading this number of bytes:
+MMAP_RELEASE = 64 * 1024 * 1024
+# Compressions of mbox files by their magic bytes:
+COMPRESSIONS = [(b"\x1f\x8b", "gzip"), (b"BZh", "bz2"), (b"\xfd7zXZ\x00", "xz")]
+# Suffixes of compressed result files:
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "bz2": ".bz2", "xz": ".xz"}
+# Compress result files by (default):
+DEFAULT_COMPRESSION = None
+# Compression level of gzip result files:
+GZIP_LEVEL = 6
+# Start of a gzip member compressed by deflate:
+GZIP_MAGIC = b"\x1f\x8b\x08"
+# Read compressed mbox files in blocks of this number of bytes:
+STREAM_BLOCK = 1024 * 1024
+# Number of decompressed blocks waiting to be split into mails:
+STREAM_QUEUE = 16
+# Decompress a piece of a gzip file in a worker up to this multiple of its size, else stream it:
+STREAM_RATIO = 16
+# Keep digests of passed mails in memory: "set", "bloom", None "bloom" if indexing, False never (default):
+DEFAULT_DEDUP = None
+# Number of digests a Bloom filter is sized for at least (default):
+DEFAULT_DEDUP_CAPACITY = 1024 * 1024
+# False positive rate of a Bloom filter:
+DEDUP_ERROR = 0.01
+# Modes of keeping digests in memory:
+DEDUP_MODES = ["set", "bloom"]
+# Number of worker processes (default):
+DEFAULT_JOBS = 1
+# Split mboxes into chunks of about this number of bytes for workers (default):
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+# Resume mbox files from the last checkpoint (default):
+DEFAULT_RESUME = False
+# Bytes at the start and before a checkpoint compared to detect rewritten mbox files:
+CHECKPOINT_FINGERPRINT = 4096
+# Seconds after the last modification of a mbox file, its last mail counts as complete:
+CHECKPOINT_SETTLE = 5.0
+# Decode attachments in chunks of this number of characters (default):
+DEFAULT_EXPORT_BUFFER = 1024 * 1024
+# Fsync exported attachments after this number of files, 0 never (default):
+DEFAULT_EXPORT_FSYNC = 0
+# Bytes of cached mails and payloads kept in memory, None unbounded (default):
+DEFAULT_CACHE_BUDGET = 256 * 1024 * 1024
+# Time stages of filtering (default):
+DEFAULT_STATS = False
+# Seconds between progress messages, 0 none (default):
+DEFAULT_PROGRESS = 0
+# Methods of Filter replaced while writing by background threads:
+WRITER_METHODS = ["resultset_write", "payload_write", "index_flush", "attachment_add", "attachment_flush"]
+# Methods of Filter timed as stages:
+STATS_STAGES = ["filter_entry", "mail_parse", "filter_mail_pass", "payload_parse", "index_add", "index_flush", "sort_keys_generate", "resultset_output", "resultset_cache"]
+# Index subjects and text parts for full-text search (default):
+DEFAULT_FULLTEXT = False
+# Store exported payloads by content (default):
+DEFAULT_EXPORT_STORE = False
+# Maximum number of sort keys per mail, 0 unbounded (default):
+DEFAULT_MAX_KEYS = 0
+# Write unmodified mails by their raw bytes (default):
+DEFAULT_PASSTHROUGH = True
+# Copy raw mails of this number of bytes or more in the kernel:
+COPY_MIN = 1024 * 1024
+# Encoding of serialized mails in result mboxes:
+OUTPUT_ENCODING = "utf-8"
+# Number of background writer threads, 0 writes while filtering (default):
+DEFAULT_WRITERS = 0
+# Number of write items waiting for the writer threads (default):
+DEFAULT_WRITE_QUEUE = 256
+# Directory levels of the payload store:
+STORE_LEVELS = 2
+# Number of raw header values kept decoded across mails:
+HEADER_CACHE_SIZE = 8192
+# Parse the whole mail only if its header passes the filters (default):
+DEFAULT_SCAN_HEADERS = False
+# Match filters case-insensitive (default):
+DEFAULT_IGNORECASE = False
+# Match filters as fixed strings instead of regular expressions (default):
+DEFAULT_FIXED_STRINGS = False
+
+# Dates like "Fri, 21 Jun 2013 12:15:00 +0200 (CEST)", parsed without email.utils:
+DATE_PATTERN = re.compile(r"\s*(?:[A-Za-z]+,\s*)?(\d{1,2})\s+([A-Za-z]{3})\s+(\d{4})\s+(\d{1,2}):(\d{2})(?::(\d{2}))?\s+([+-]\d{4})\s*(?:\([^()]*\)\s*)?$")
+# Months of the fast path:
+DATE_MONTHS = {"jan": 1, "feb": 2, "mar": 3, "apr": 4, "may": 5, "jun": 6, "jul": 7, "aug": 8, "sep": 9, "oct": 10, "nov": 11, "dec": 12}
+
+# Bytes skipped when decoding base64:
+BASE64_IGNORED = bytes(set(range(256)) - set(b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/="))
+# Readers of mbox files:
+READERS = ["mailbox", "mmap"]
+# Columns of the result index answering filters by header field:
+INDEX_COLUMNS = {"Date": "Date", "Subject": "Subject"}
+# Header fields of the result index split into the table Addresses:
+INDEX_ADDRESS_FIELDS = ["From", "To", "Cc", "Bcc"]
+# Literal Date filters naming a year, narrowed by the index on Timestamp:
+INDEX_DATE_YEAR = re.compile(r"[\w ,:+-]*?(?<!\d)(\d{4})(?!\d)[\w ,:+-]*")
+# Seconds a Date in local time may differ from UTC:
+INDEX_DATE_MARGIN = 86400
 
 class FilterBaseException(Exception):
 	mesg=""
@@ -67,7 +205,7 @@ class HeaderMissed(FilterException):
 	mesg = "header not found: %s"
 
 class RegularExpressionError(FilterException):
-	mesg = "regular expr. invalid: "
+	mesg = "regular expr. invalid: %s"
 
 class EmailMissed(FilterBaseException):
 	mesg = "email address not found"
@@ -78,72 +216,970 @@ class EmptyKeyPart(FilterBaseException):
 class CLIProtocollError(FilterBaseException):
 	mesg = "syntax error, expect: Header,Regexp"
 
+class ReaderUnknown(FilterException):
+	mesg = "reader unknown: %s"
+
+class CompressionUnavailable(FilterException):
+	mesg = "compression not available: %s"
+
+class DedupUnknown(FilterException):
+	mesg = "dedup mode unknown: %s"
+
+class MailDuplicate(FilterException):
+	mesg = "mail passed before: %s"
+
+class HeaderNotIndexed(FilterException):
+	mesg = "header not in result index: %s"
+
+class DateInvalid(FilterException):
+	mesg = "date invalid: %s"
+
+class FulltextUnavailable(FilterException):
+	mesg = "full-text index not available: %s"
+
+class SortKeysExceeded(FilterException):
+	mesg = "too many sort keys: %s"
+
+class OutputPool:
+	""" Keep a bounded number of buffered append handles open, closing the least recently used first. """
+	def __init__(self, max_open=DEFAULT_MAX_OPEN, buffering=DEFAULT_BUFFERING, compression=DEFAULT_COMPRESSION):
+		# Maximum number of open handles:
+		self.max_open = max(1, max_open)
+		# Write buffer size per handle:
+		self.buffering = buffering
+		# Append a compressed stream per open handle:
+		self.compression = compression
+		# Open handles by path, least recently used first:
+		self.handles = collections.OrderedDict()
+		# Number of requests served by an open handle:
+		self.hits = 0
+		# Number of requests which opened a handle:
+		self.misses = 0
+		# Number of handles closed to stay below max_open:
+		self.evictions = 0
+		# Bytes written by closed handles:
+		self.written = 0
+		# Size of the files of the open handles when opened:
+		self.positions = {}
+
+	def handle(self, path):
+		""" Return an open append handle for path. """
+		if path in self.handles:
+			self.hits += 1
+			self.handles.move_to_end(path)
+			return self.handles[path]
+		self.misses += 1
+		while len(self.handles) >= self.max_open:
+			self.release(*self.handles.popitem(last=False))
+			self.evictions += 1
+		handle = self.open(path)
+		self.handles[path] = handle
+		self.positions[path] = os.path.getsize(path)
+		return handle
+
+	def release(self, path, handle):
+		""" Close a handle and count the bytes written to its file. """
+		try:
+			handle.close()
+		finally:
+			self.written += os.path.getsize(path) - self.positions.pop(path, 0)
+
+	def open(self, path):
+		""" Open path for appending bytes, compressed in a stream of its own. """
+		if self.compression is not None:
+			return io.BufferedWriter(compress_open(path, "ab", self.compression), self.buffering)
+		return open(path, "ab", buffering=self.buffering)
+
+	def flush(self):
+		""" Flush all open handles. """
+		for handle in self.handles.values():
+			handle.flush()
+
+	def close(self):
+		""" Flush and close all open handles, even if one of them fails. """
+		excp = None
+		while self.handles:
+			try:
+				self.release(*self.handles.popitem(last=False))
+			except Exception as err:
+				excp = excp or err
+		if excp is not None:
+			raise excp
+
+	def statistics(self):
+		""" Return hit and miss counts of the pool. """
+		return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "open": len(self.handles), "max_open": self.max_open}
+
+class Dedup:
+	""" Digests of the passed mails, kept in a set or in a Bloom filter. A hit of a Bloom filter needs an exact check.
+		A full Bloom filter is followed by one of twice the capacity and half the error, the errors of all stay below error. """
+	def __init__(self, capacity=DEFAULT_DEDUP_CAPACITY, exact=True, error=DEDUP_ERROR):
+		self.capacity = max(1, capacity)
+		self.error = error
+		self.exact = exact
+		# Digests, if exact:
+		self.digests = set() if exact else None
+		# Bloom filters as size, number of bits set per digest, bits and capacity, if not exact:
+		self.filters = []
+		# Digests added to the last filter:
+		self.filled = 0
+		if not exact:
+			self.grow()
+		self.added = 0
+		self.checks = 0
+		self.hits = 0
+		self.duplicates = 0
+
+	def grow(self):
+		""" Add a Bloom filter, which takes the digests from now on. """
+		capacity = self.capacity << len(self.filters)
+		error = self.error / 2 ** (len(self.filters) + 1)
+		size = max(64, int(math.ceil(-capacity * math.log(error) / math.log(2) ** 2)))
+		self.filters.append((size, max(1, int(round(size / capacity * math.log(2)))), bytearray((size + 7) // 8), capacity))
+		self.filled = 0
+
+	def positions(self, digest, size, hashes):
+		""" Return the bits of digest in a filter of size bits by double hashing its halves. """
+		first = int.from_bytes(digest[:8], "little")
+		second = int.from_bytes(digest[8:16], "little") | 1
+		return [(first + idx * second) % size for idx in range(hashes)]
+
+	def seen(self, digest):
+		""" Return True if digest was added before, False if not and None if it may have been. """
+		self.checks += 1
+		if self.exact:
+			seen = digest in self.digests
+		else:
+			seen = False
+			for size, hashes, bits, capacity in self.filters:
+				if all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(digest, size, hashes)):
+					seen = None
+					break
+		if seen is not False:
+			self.hits += 1
+		return seen
+
+	def add(self, digest):
+		""" Remember digest. """
+		self.added += 1
+		if self.exact:
+			self.digests.add(digest)
+			return
+		if self.filled >= self.filters[-1][3]:
+			self.grow()
+		size, hashes, bits, capacity = self.filters[-1]
+		for pos in self.positions(digest, size, hashes):
+			bits[pos >> 3] |= 1 << (pos & 7)
+		self.filled += 1
+
+	def statistics(self):
+		""" Return the number of digests, checks, hits and duplicates. """
+		return {"mode": "set" if self.exact else "bloom", "digests": self.added, "checks": self.checks, "hits": self.hits, "duplicates": self.duplicates, "bits": None if self.exact else sum(size for size, hashes, bits, capacity in self.filters), "filters": len(self.filters)}
+
+class Writer:
+	""" Threads draining bounded queues of write items, the items of a route are written in order by one thread. """
+	def __init__(self, threads=1, size=DEFAULT_WRITE_QUEUE, max_open=DEFAULT_MAX_OPEN, buffering=DEFAULT_BUFFERING, compression=DEFAULT_COMPRESSION):
+		threads = max(1, threads)
+		# Queue and handle pool by thread:
+		self.queues = [queue.Queue(max(1, size // threads)) for idx in range(threads)]
+		self.pools = [OutputPool(max(1, max_open // threads), buffering, compression) for idx in range(threads)]
+		# Failed items as (sequence number, message, mail):
+		self.failures = collections.deque()
+		# Connection to the result index, used by the first thread only:
+		self.db = None
+		# Stored payloads waiting for the next commit, first thread only:
+		self.attachment_rows = []
+		# Number of items which waited for a full queue:
+		self.waits = 0
+		# Running threads, started by the first item:
+		self.threads = []
+
+	def start(self):
+		""" Start a thread per queue. """
+		for idx in range(len(self.queues)):
+			thread = threading.Thread(target=self.run, args=(idx,), name="mboxfilter-writer-%s" %idx)
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+
+	def submit(self, route, seq, mail, function, *args):
+		""" Queue the call function(pool, *args), block while the queue of route is full. Items without route go to the first thread. """
+		if not self.threads:
+			self.start()
+		idx = binascii.crc32(route.encode("utf-8", "surrogatepass")) % len(self.queues) if route else 0
+		handle = self.queues[idx]
+		if handle.full():
+			self.waits += 1
+		handle.put((seq, mail, function, args))
+
+	def run(self, idx):
+		""" Call the items of a queue until stopped. """
+		handle = self.queues[idx]
+		pool = self.pools[idx]
+		while True:
+			item = handle.get()
+			try:
+				if item is None:
+					return
+				seq, mail, function, args = item
+				try:
+					function(pool, *args)
+				except Exception as excp:
+					self.failures.append((seq, str(excp), mail))
+			finally:
+				handle.task_done()
+
+	def flush(self):
+		""" Wait until all items are written, then close all handles. """
+		for handle in self.queues:
+			handle.join()
+		excp = None
+		for pool in self.pools:
+			try:
+				pool.close()
+			except Exception as err:
+				excp = excp or err
+		if excp is not None:
+			raise excp
+
+	def close(self):
+		""" Write all items and stop the threads. """
+		try:
+			self.flush()
+		finally:
+			if self.threads:
+				for handle in self.queues:
+					handle.put(None)
+				for thread in self.threads:
+					thread.join()
+				self.threads = []
+			if self.db is not None:
+				self.db.close()
+				self.db = None
+
+	def written(self):
+		""" Return the bytes written by closed handles. """
+		return sum(pool.written for pool in self.pools)
+
+	def statistics(self):
+		""" Return the number of threads, waits for a full queue and the handle pool statistics. """
+		pools = [pool.statistics() for pool in self.pools]
+		result = {"threads": len(self.queues), "waits": self.waits}
+		for name in ["hits", "misses", "evictions", "open"]:
+			result[name] = sum(pool[name] for pool in pools)
+		return result
+
+class Stats:
+	""" Cumulative wall and CPU time per stage, bytes read and exported. """
+	def __init__(self):
+		# Calls, wall time, CPU time and nesting depth by stage:
+		self.stages = collections.OrderedDict()
+		self.bytes_read = 0
+		self.bytes_exported = 0
+		self.started = time.time()
+		# Time of the last progress message:
+		self.reported = self.started
+
+	def wrap(self, name, function, after=None):
+		""" Return function timing its calls as stage name, recursive calls are timed once. """
+		stage = self.stages.setdefault(name, [0, 0.0, 0.0, 0])
+		def timed(*args, **kwargs):
+			if stage[3]:
+				return function(*args, **kwargs)
+			stage[3] = 1
+			wall, cpu = time.perf_counter(), time.process_time()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				stage[0] += 1
+				stage[1] += time.perf_counter() - wall
+				stage[2] += time.process_time() - cpu
+				stage[3] = 0
+				if after is not None:
+					after()
+		return timed
+
+	def dump(self):
+		""" Return the counts of a worker process and reset them. """
+		counts = {"stages": dict((name, stage[:3]) for name, stage in self.stages.items()), "bytes_exported": self.bytes_exported}
+		for stage in self.stages.values():
+			stage[:3] = [0, 0.0, 0.0]
+		self.bytes_exported = 0
+		return counts
+
+	def merge(self, counts):
+		""" Add the counts of a worker process. """
+		for name, (calls, wall, cpu) in counts["stages"].items():
+			stage = self.stages.setdefault(name, [0, 0.0, 0.0, 0])
+			stage[0] += calls
+			stage[1] += wall
+			stage[2] += cpu
+		self.bytes_exported += counts["bytes_exported"]
+
+	def statistics(self):
+		""" Return the times per stage and the bytes counted. """
+		elapsed = time.time() - self.started
+		return {
+			"elapsed": elapsed,
+			"bytes_read": self.bytes_read,
+			"bytes_exported": self.bytes_exported,
+			"stages": collections.OrderedDict((name, {"calls": stage[0], "wall": stage[1], "cpu": stage[2]}) for name, stage in self.stages.items()),
+		}
+
+class FilterMatcher:
+	""" Match header values against compiled regular expressions or fixed strings. """
+	def __init__(self, header, patterns, ignorecase=False, fixed=False):
+		# Header field to match:
+		self.header = header
+		# Patterns matched by this matcher:
+		self.patterns = list(patterns)
+		if fixed:
+			self.strings = [pattern.lower() if ignorecase else pattern for pattern in self.patterns]
+			self.search = self.search_fixed_lower if ignorecase else self.search_fixed
+		else:
+			self.regexp = filter_compile(self.patterns, re.IGNORECASE if ignorecase else 0)
+			self.search = self.regexp.search
+
+	def search_fixed(self, value):
+		""" True if any fixed string is a substring of value. """
+		for strg in self.strings:
+			if strg in value:
+				return True
+		return False
+
+	def search_fixed_lower(self, value):
+		""" True if any fixed string is a substring of value, ignoring case. """
+		return self.search_fixed(value.lower())
+
+class FilterPlan:
+	""" Filters compiled once and grouped by header field. """
+	def __init__(self, filters, or_logic=DEFAULT_FILTER_OR_LOGIC, ignorecase=DEFAULT_IGNORECASE, fixed_strings=DEFAULT_FIXED_STRINGS):
+		# Matchers in order of evaluation:
+		self.matchers = []
+		groups = collections.OrderedDict()
+		for item in filters:
+			header, pattern = item[0], item[1]
+			options = item[2] if len(item) > 2 else ""
+			icase = ignorecase or "i" in options
+			fixed = fixed_strings or "f" in options
+			if not fixed:
+				# Fail on construction, not on the first mail:
+				filter_compile([pattern], re.IGNORECASE if icase else 0)
+			# Filters of one header can only share a matcher, if any of them decides:
+			if or_logic and (fixed or filter_combinable(pattern)):
+				groups.setdefault((header, icase, fixed), []).append(pattern)
+			else:
+				groups[(header, icase, fixed, len(groups))] = [pattern]
+		for key, patterns in groups.items():
+			self.matchers.append(FilterMatcher(key[0], patterns, key[1], key[2]))
+
+	def __iter__(self):
+		return iter(self.matchers)
+
+	def __len__(self):
+		return len(self.matchers)
+
+class HeaderCache:
+	""" Bounded LRU cache of decoded header values, counting hits and misses. """
+	def __init__(self, maxsize=HEADER_CACHE_SIZE):
+		# Maximum number of values kept:
+		self.maxsize = maxsize
+		# Values by key, least recently used first:
+		self.values = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key, function, *args):
+		""" Return the cached value of key, compute it by function(*args) on a miss. """
+		try:
+			value = self.values[key]
+		except KeyError:
+			self.misses += 1
+			value = self.values[key] = function(*args)
+			if len(self.values) > self.maxsize:
+				self.values.popitem(last=False)
+			return value
+		self.hits += 1
+		self.values.move_to_end(key)
+		return value
+
+	def clear(self):
+		""" Remove all values and reset the counts. """
+		self.values.clear()
+		self.hits = self.misses = 0
+
+	def statistics(self):
+		""" Return hit and miss counts of the cache. """
+		return {"hits": self.hits, "misses": self.misses, "size": len(self.values), "maxsize": self.maxsize}
+
+class SpoolBudget:
+	""" Memory budget shared by the spools of a Filter. """
+	def __init__(self, limit=DEFAULT_CACHE_BUDGET):
+		# Bytes kept in memory at most, None unbounded:
+		self.limit = limit
+		self.used = 0
+		# Number of items spilled to disk:
+		self.spilled = 0
+
+	def reserve(self, size):
+		""" Account size bytes, return False if they exceed the budget. """
+		if self.limit is not None and self.used + size > self.limit:
+			return False
+		self.used += size
+		return True
+
+	def release(self, size):
+		""" Give size bytes back to the budget. """
+		self.used = max(0, self.used - size)
+
+	def statistics(self):
+		""" Return the bytes used and the number of items spilled. """
+		return {"used": self.used, "limit": self.limit, "spilled": self.spilled}
+
+class Spool:
+	""" Sequence of mails or payloads kept in memory up to a budget, pickled to a temporary file beyond. """
+	def __init__(self, budget):
+		self.budget = budget
+		# Items in memory, followed by the items on disk:
+		self.items = []
+		# Offset and length of the items on disk:
+		self.offsets = []
+		self.handle = None
+		# Bytes of the budget used by the items in memory:
+		self.reserved = 0
+
+	def append(self, item):
+		# Keep the order, once items went to disk:
+		size = spool_size(item)
+		if not self.offsets and self.budget.reserve(size):
+			self.items.append(item)
+			self.reserved += size
+			return
+		if self.handle is None:
+			self.handle = tempfile.TemporaryFile(prefix="mboxfilter-")
+		data = pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+		self.handle.seek(0, os.SEEK_END)
+		self.offsets.append((self.handle.tell(), len(data)))
+		self.handle.write(data)
+		self.budget.spilled += 1
+
+	def __len__(self):
+		return len(self.items) + len(self.offsets)
+
+	def __getitem__(self, idx):
+		if isinstance(idx, slice):
+			return [self[pos] for pos in range(*idx.indices(len(self)))]
+		if idx < 0:
+			idx += len(self)
+		if not 0 <= idx < len(self):
+			raise IndexError(idx)
+		if idx < len(self.items):
+			return self.items[idx]
+		offset, length = self.offsets[idx - len(self.items)]
+		self.handle.seek(offset)
+		return pickle.loads(self.handle.read(length))
+
+	def __iter__(self):
+		""" Iterate lazily, items on disk are loaded one by one. """
+		for idx in range(len(self)):
+			yield self[idx]
+
+	def __add__(self, other):
+		return SpoolChain(self, other)
+
+	def __radd__(self, other):
+		return SpoolChain(other, self)
+
+	def close(self):
+		""" Remove the items on disk and give the memory of the others back to the budget. """
+		if self.handle is not None:
+			self.handle.close()
+			self.handle = None
+		self.budget.release(self.reserved)
+		self.reserved = 0
+		self.items = []
+		self.offsets = []
+
+class SpoolChain:
+	""" Sequences concatenated without loading their items. """
+	def __init__(self, *parts):
+		self.parts = parts
+
+	def __len__(self):
+		return sum(len(part) for part in self.parts)
+
+	def __getitem__(self, idx):
+		if isinstance(idx, slice):
+			return [self[pos] for pos in range(*idx.indices(len(self)))]
+		if idx < 0:
+			idx += len(self)
+		if idx >= 0:
+			for part in self.parts:
+				if idx < len(part):
+					return part[idx]
+				idx -= len(part)
+		raise IndexError(idx)
+
+	def __iter__(self):
+		return itertools.chain.from_iterable(self.parts)
+
+	def __add__(self, other):
+		return SpoolChain(self, other)
+
+	def __radd__(self, other):
+		return SpoolChain(other, self)
+
+class SpoolView(Spool):
+	""" Sequence of items of a spool referenced by their indexes. """
+	def __init__(self, spool):
+		self.spool = spool
+		self.indexes = []
+
+	def append(self, idx):
+		self.indexes.append(idx)
+
+	def __len__(self):
+		return len(self.indexes)
+
+	def __getitem__(self, idx):
+		if isinstance(idx, slice):
+			return [self.spool[pos] for pos in self.indexes[idx]]
+		return self.spool[self.indexes[idx]]
+
+	def close(self):
+		self.indexes = []
+
+class MailView:
+	""" Decoded header values of one mail, computed once. """
+	def __init__(self, mail, statistics):
+		self.mail = mail
+		# Hit and miss counts shared by the views of a Filter:
+		self.statistics = statistics
+		self.keys = None
+		self.decoded = {}
+		self.split = {}
+
+	def decode(self, header):
+		""" Return the decoded value of header. """
+		try:
+			value = self.decoded[header]
+			self.statistics["hits"] += 1
+		except KeyError:
+			self.statistics["misses"] += 1
+			value = self.decoded[header] = header_decode(self.mail[header])
+		return value
+
+	def values(self, header):
+		""" Return the decoded value of header split into a list. """
+		try:
+			values = self.split[header]
+			self.statistics["hits"] += 1
+		except KeyError:
+			if self.keys is None:
+				self.keys = set(self.mail.keys())
+			if header not in self.keys:
+				raise HeaderMissed(header)
+			values = self.split[header] = header_split(header, self.decode(header))
+		return values
+
+class MailEntry:
+	""" Entry of a parsed mail. """
+	# Parser for the header block:
+	parser = email.parser.BytesHeaderParser()
+
+	def __init__(self, mail):
+		self.mail = mail
+
+	def headers(self):
+		""" Return the mail. """
+		return self.mail
+
+	def message(self):
+		""" Return the mail. """
+		return self.mail
+
+	def location(self):
+		""" Return path, byte offset and length of the mail in a mbox file, None if unknown. """
+		return None
+
+	def raw(self):
+		""" Return the bytes of the entry in a mbox file, None if unknown. """
+		return None
+
+	def source(self):
+		""" Return file descriptor, byte offset and length of the entry including the closing blank line, None if unknown. """
+		return None
+
+class MboxEntry(MailEntry):
+	""" Entry of a mailbox.mbox, parsed on demand. """
+	def __init__(self, mbox, key):
+		self.mbox = mbox
+		self.key = key
+		self.mail = None
+
+	def headers(self):
+		""" Return a message holding the header block only. """
+		lines = []
+		handle = self.mbox.get_file(self.key)
+		try:
+			for line in handle:
+				if line in (b"\n", b"\r\n"):
+					break
+				lines.append(line)
+		finally:
+			handle.close()
+		return self.parser.parsebytes(b"".join(lines))
+
+	def message(self):
+		""" Return the whole mail. """
+		if self.mail is None:
+			self.mail = self.mbox[self.key]
+		return self.mail
+
+	def raw(self):
+		""" Return the bytes of the entry including the From line and the closing blank line. """
+		return self.mbox.get_bytes(self.key, True) + b"\n"
+
+	def location(self):
+		""" Return path, byte offset and length up to the next From line, as MmapEntry does, by the table of contents. """
+		toc = self.mbox._toc
+		start = toc[self.key][0]
+		stop = toc[self.key + 1][0] if self.key + 1 in toc else self.mbox._file_length
+		return os.path.abspath(self.mbox._path), start, stop - start
+
+class MmapEntry(MailEntry):
+	""" Entry of a memory mapped mbox, referenced by byte offset and length. """
+	def __init__(self, mbox, offset, length):
+		self.mbox = mbox
+		self.offset = offset
+		self.length = length
+		self.mail = None
+
+	def raw(self):
+		""" Return the bytes of the entry including the From line. """
+		return self.mbox.map[self.offset:self.offset + self.length]
+
+	def headers(self):
+		""" Return a message holding the header block only. """
+		mapped = self.mbox.map
+		stop = self.offset + self.length
+		start = mapped.find(b"\n", self.offset, stop) + 1
+		ends = [pos for pos in (mapped.find(b"\n\n", start - 1, stop), mapped.find(b"\n\r\n", start - 1, stop)) if pos >= 0]
+		end = min(ends) + 1 if ends else stop
+		return self.parser.parsebytes(mapped[start:end])
+
+	def message(self):
+		""" Return the whole mail. """
+		if self.mail is None:
+			data = self.raw()
+			pos = data.find(b"\n") + 1
+			# The blank line before the next From line belongs to the separator:
+			body = data[pos:-1] if data.endswith(b"\n\n") else data[pos:]
+			self.mail = mailbox.mboxMessage(body)
+			self.mail.set_from(data[5:pos].rstrip(b"\r\n").decode("ascii", "replace"))
+		return self.mail
+
+	def location(self):
+		return self.mbox.location, self.offset, self.length
+
+	def source(self):
+		stop = self.offset + self.length
+		if self.mbox.map[stop - 2:stop] != b"\n\n":
+			return None
+		return self.mbox.handle.fileno(), self.offset, self.length
+
+class MmapMbox:
+	""" Memory mapped mbox, split into entries by a bytes scan for From lines. """
+	def __init__(self, path, start=0, stop=None):
+		# Path of the mbox:
+		self.path = path
+		# Path of the mbox in the result index:
+		self.location = os.path.abspath(path)
+		# Read entries from byte offset:
+		self.start = start
+		self.handle = open(path, "rb")
+		# Size of the mbox in bytes:
+		self.size = os.fstat(self.handle.fileno()).st_size
+		# Read entries up to byte offset:
+		self.stop = self.size if stop is None else min(stop, self.size)
+		self.map = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b""
+
+	def __iter__(self):
+		""" Yield an entry for every mail. """
+		for offset, length in self.offsets():
+			yield MmapEntry(self, offset, length)
+
+	def offsets(self):
+		""" Yield offset and length of every mail. """
+		mapped = self.map
+		pos = self.start
+		if mapped[pos:pos + 5] != b"From ":
+			pos = mapped.find(b"\nFrom ", pos) + 1
+			if pos == 0:
+				return
+		released = pos
+		while pos < self.stop:
+			nxt = mapped.find(b"\nFrom ", pos, self.stop) + 1 or self.stop
+			yield pos, nxt - pos
+			# Keep the resident set flat on large mboxes:
+			if nxt - released >= MMAP_RELEASE:
+				self.release(released, nxt)
+				released = nxt
+			pos = nxt
+
+	def chunks(self, size=DEFAULT_CHUNK_SIZE):
+		""" Yield byte ranges of about size bytes, split on From lines. """
+		pos = self.start
+		while pos < self.stop:
+			nxt = self.map.find(b"\nFrom ", pos + max(1, size) - 1, self.stop) + 1 or self.stop
+			yield pos, nxt
+			pos = nxt
+
+	def release(self, start, stop):
+		""" Drop mapped pages of a range already read. """
+		if hasattr(self.map, "madvise") and hasattr(mmap, "MADV_DONTNEED"):
+			start -= start % mmap.PAGESIZE
+			self.map.madvise(mmap.MADV_DONTNEED, start, stop - start)
+
+	def close(self):
+		""" Unmap and close the mbox. """
+		if self.size:
+			self.map.close()
+		self.handle.close()
+
+class BytesEntry(MmapEntry):
+	""" Entry of a mbox stream, held as bytes. """
+	def __init__(self, data):
+		# The entry is its own mbox:
+		MmapEntry.__init__(self, self, 0, len(data))
+		self.map = data
+
+	def location(self):
+		return None
+
+	def source(self):
+		return None
+
+class StreamMbox:
+	""" Mbox read from a compressed file, decompressed by a thread and split into entries by a bytes scan for From lines.
+		Members of gzip files are decompressed by jobs worker processes in parallel. """
+	def __init__(self, path, compression, jobs=1, chunk_size=DEFAULT_CHUNK_SIZE):
+		self.path = path
+		self.compression = compression
+		self.jobs = jobs
+		self.chunk_size = chunk_size
+		# Decompressed blocks, None at the end:
+		self.queue = queue.Queue(STREAM_QUEUE)
+		self.closed = False
+		self.thread = threading.Thread(target=self.run, name="mboxfilter-reader")
+		self.thread.daemon = True
+		self.thread.start()
+
+	def run(self):
+		""" Decompress the file into the queue. """
+		try:
+			if self.compression == "gzip" and self.jobs > 1:
+				blocks = gzip_blocks(self.path, self.jobs, self.chunk_size)
+			else:
+				blocks = stream_blocks(self.path, self.compression)
+			for block in blocks:
+				if self.closed:
+					blocks.close()
+					break
+				self.queue.put(block)
+			self.queue.put(None)
+		except Exception as excp:
+			self.queue.put(excp)
+
+	def blocks(self):
+		""" Yield decompressed blocks, raise the errors of the thread. """
+		while True:
+			block = self.queue.get()
+			if block is None:
+				return
+			if isinstance(block, Exception):
+				raise block
+			yield block
+
+	def __iter__(self):
+		""" Yield an entry for every mail. """
+		buf = bytearray()
+		started = False
+		for block in self.blocks():
+			# A From line may start in the bytes read before:
+			scan = max(0, len(buf) - 5)
+			buf += block
+			pos = 0
+			if not started:
+				if buf[:5] != b"From ":
+					pos = buf.find(b"\nFrom ", scan) + 1
+					if pos == 0:
+						del buf[:-5]
+						continue
+				started = True
+			while True:
+				nxt = buf.find(b"\nFrom ", max(pos, scan)) + 1
+				if nxt == 0:
+					break
+				yield BytesEntry(bytes(buf[pos:nxt]))
+				pos = nxt
+			del buf[:pos]
+		if started and buf:
+			yield BytesEntry(bytes(buf))
+
+	def close(self):
+		""" Stop the thread. """
+		self.closed = True
+		while self.thread.is_alive():
+			try:
+				self.queue.get(timeout=0.1)
+			except queue.Empty:
+				pass
+
 class Filter:
 	# Number of deleted payloads:
 	deleted = 0
-	# List of indexes of payloads to be deleted:
-	delete_marked = []
 	# Number of exported payloads:
 	exported = 0
-	# Keep exported payloads
-	exported_payloads = []
+	# Keep exported payloads, when caching:
+	exported_payloads = None
 	# Failed while processing:
 	failed = 0
 	# Keep failed mails, when caching:
-	failed_mails = []
+	failed_mails = None
 	# Keep filter matches in List:
 	filter_matches = []
+	# Compiled filters:
+	filter_plan = []
 	# Number of filtered mails:
 	filtered = 0
 	# Do indexing by default:
 	indexing = False
 	# Number of passed mails:
 	passed = 0
+	# Number of distinct payloads stored by content:
+	stored = 0
+	# Number of payloads visited:
+	visited = 0
+	# Number of mails exceeding the maximum number of sort keys:
+	exceeded = 0
 	# Keep passed mails, when caching:
-	passed_mails = []
+	passed_mails = None
 	# Filname of index database:
 	resultset_index = DEFAULT_DB
-	# Reference passed mails by key:
-	resultset = {}
+	# Reference passed mails by key, when caching:
+	resultset = None
 	# Do sorting by default:
 	sort_date_default = DEFAULT_FORMAT
 	# Keep sort keys in list:
 	sort_keys = []  
-	def __init__(self, output=DEFAULT_OUTPUT, archive=DEFAULT_ARCHIVE, indexing=DEFAULT_INDEX, filters=[], filter_or_logic=DEFAULT_FILTER_OR_LOGIC, selectors=[], caching=DEFAULT_CACHEING, separator=DEFAULT_SEPARATOR, failures=DEFAULT_FAILURES, export_payload=DEFAULT_EXPORT, reduce_payload=DEFAULT_REDUCE, payload_exportpath=None, quiet=DEFAULT_QUIET):
+	def __init__(self, output=DEFAULT_OUTPUT, archive=DEFAULT_ARCHIVE, indexing=DEFAULT_INDEX, filters=[], filter_or_logic=DEFAULT_FILTER_OR_LOGIC, selectors=[], caching=DEFAULT_CACHEING, separator=DEFAULT_SEPARATOR, failures=DEFAULT_FAILURES, export_payload=DEFAULT_EXPORT, reduce_payload=DEFAULT_REDUCE, payload_exportpath=None, quiet=DEFAULT_QUIET, max_open=DEFAULT_MAX_OPEN, buffering=DEFAULT_BUFFERING, index_batch=DEFAULT_INDEX_BATCH, index_interval=DEFAULT_INDEX_INTERVAL, journal_mode=DEFAULT_JOURNAL_MODE, synchronous=DEFAULT_SYNCHRONOUS, ignorecase=DEFAULT_IGNORECASE, fixed_strings=DEFAULT_FIXED_STRINGS, scan_headers=DEFAULT_SCAN_HEADERS, reader=DEFAULT_READER, jobs=DEFAULT_JOBS, chunk_size=DEFAULT_CHUNK_SIZE, resume=DEFAULT_RESUME, export_buffer=DEFAULT_EXPORT_BUFFER, export_fsync=DEFAULT_EXPORT_FSYNC, export_store=DEFAULT_EXPORT_STORE, cache_budget=DEFAULT_CACHE_BUDGET, fulltext=DEFAULT_FULLTEXT, stats=DEFAULT_STATS, progress=DEFAULT_PROGRESS, since=None, until=None, max_keys=DEFAULT_MAX_KEYS, passthrough=DEFAULT_PASSTHROUGH, writers=DEFAULT_WRITERS, write_queue=DEFAULT_WRITE_QUEUE, compression=DEFAULT_COMPRESSION, dedup=DEFAULT_DEDUP, dedup_capacity=DEFAULT_DEDUP_CAPACITY):
 		""" Initialize a Filter object.
 			archive
 				Archives emails. Same as indexing=True and selectors=[("Date", "Y")] (default False)
 
+			cache_budget
+				Keeps cached mails and payloads of about this number of bytes in memory, the rest in
+				temporary files. None keeps all in memory (default 256 MiB)
+
 			caching
 				Caches resultset. Disables output and indexing. (default False)
+
+			chunk_size
+				Splits mbox files into chunks of about this number of bytes for worker processes (default 8 MiB)
 		
+			export_buffer
+				Decodes exported payloads in chunks of this number of characters (default 1 MiB)
+
+			export_fsync
+				Fsyncs exported payloads after this number of files, 0 never (default 0)
+
 			export_payload
 				Exports payloads with a filename attribute (default False)
+
+			export_store
+				Stores every distinct exported payload once, named by its SHA-256 value. The payloads
+				of a mail are listed in the table Attachments of the index database (default False)
 				
+			buffering
+				Write buffer size of result mboxes in bytes (default 1 MiB)
+
+			index_batch
+				Commits index rows in one transaction after this number of mails (default 1000)
+
+			index_interval
+				Commits index rows in one transaction after this number of seconds (default 5.0)
+
 			indexing
 				Creates a index database called index.sqlite3. (default False)
 
+			jobs
+				Filters mbox files by this number of worker processes (default 1)
+
+			journal_mode
+				Journal mode of the index database, None keeps the SQLite default (default "WAL")
+
+			max_open
+				Maximum number of result mboxes kept open at once (default 128)
+
 			failure
 				Appends failed mails to given file (default None)
 
 			filters
-				List of tuples, e.g. ("From", regexp), ("To", regexp) or ("Date", format)
+				List of tuples, e.g. ("From", regexp), ("To", regexp) or ("Date", format). A third item
+				"i" matches case-insensitive, "f" matches a fixed string, e.g. ("From", "peter@", "if")
+
+			fixed_strings
+				Matches all filters as fixed strings instead of regular expressions (default False)
+
+			fulltext
+				Indexes the subject and the text/plain parts of every mail for full-text search.
+				Implies indexing (default False)
+
+			ignorecase
+				Matches all filters case-insensitive (default False)
 
 			output
 				Redirets output to the given directory (default ./)
+
+			progress
+				Writes a progress message to STDERR every this number of seconds, implies stats (default 0)
 	 
 			payload_exportpath path
 				Exports payloads into directory (default see output)
 
+			reader
+				Reads mbox files by "mailbox" (mailbox.mbox) or "mmap" (memory mapped, default "mailbox")
+
 			reduce_payload
 				Removes all payloads not of type text (default False)
 
+			scan_headers
+				Parses only the header of a mail from a mbox, unless it passes the filters (default False)
+
+			resume
+				Filters only mails appended to a mbox file since the last run with the same settings.
+				Checkpoints are kept in the index database. (default False)
+
 			selectors
 				List of tuples, e.g. ("From", None), ("To", None), ("Date", format). mails will be output to files.
 
 			separator
 				Separates key parts (default ".")
 
+			since
+				Passes mails dated at or after this time only: seconds since the epoch, a datetime or an ISO 8601
+				or RFC 2822 date. Dates without time zone are UTC (default None)
+
+			stats
+				Times the stages of filtering, see statistics() (default False)
+
+			synchronous
+				Synchronous mode of the index database, None keeps the SQLite default (default "NORMAL")
+
+			until
+				Passes mails dated before this time only, see since (default None)
+
 			quiet
 				Supresses error messages
 		"""
@@ -159,32 +1195,148 @@ class Filter:
 		self.selectors = selectors
 		if self.archive and len(self.selectors) == 0:
 			self.selectors.append(("Date", self.sort_date_default))
-		if self.archive or indexing:
+		# Commit index rows in batches:
+		self.index_batch = max(1, index_batch)
+		self.index_interval = index_interval
+		# Pragmas of the index database:
+		self.journal_mode = journal_mode
+		self.synchronous = synchronous
+		# Index subjects and text parts:
+		self.fulltext = fulltext
+		if self.archive or indexing or fulltext:
 			self.indexing = True
 			self.index_init()
+		# Suppress duplicates by digests in memory, in front of the index:
+		if dedup not in DEDUP_MODES + [None, False]:
+			raise DedupUnknown(dedup)
+		self.dedup_capacity = dedup_capacity
+		self.dedup_init(dedup)
 		# Cache results - no output:
 		self.caching = caching
-		# TODO
-		self.passed_mails = []
+		# Spill cached results to disk beyond the budget:
+		self.spool_budget = SpoolBudget(cache_budget)
+		self.passed_mails = Spool(self.spool_budget)
+		self.failed_mails = Spool(self.spool_budget)
+		self.exported_payloads = Spool(self.spool_budget)
+		self.resultset = {}
+		# Last mail cached:
+		self.resultset_cached = None
 		# TODO
 		self.passed = 0
 		# Separate sort key items by:
 		self.sort_key_separator = separator
+		# Fail mails with more sort keys:
+		self.max_keys = max_keys
+		# Write unmodified mails by their raw bytes:
+		self.passthrough = passthrough
+		# True if payloads of the current mail were removed:
+		self.modified = False
+		# Last mail serialized and its bytes:
+		self.resultset_serialized = (None, None)
 		# Write failures to path:
 		self.failure_path = failures
 		# Delete payloads which are not text:
 		self.reduce_payload = reduce_payload
 		# Export payload which have a filename header field:
 		self.export_payload = export_payload
+		# Decoded headers of the current mail:
+		self.view = None
+		# Entry of the current mail:
+		self.entry = None
+		# Sequence number of the current mail and whether it is counted as passed:
+		self.mail_seq = 0
+		self.mail_counted = False
+		# Sequence numbers of mails failed after they passed the filters:
+		self.mail_rejected = set()
+		self.view_statistics = {"hits": 0, "misses": 0}
+		# Decode exported payloads in chunks:
+		self.export_buffer = max(4, export_buffer)
+		# Fsync exported payloads in batches:
+		self.export_fsync = export_fsync
+		self.export_unsynced = []
 		# Export payloads here:
 		if payload_exportpath:
 			self.payload_exportpath = payload_exportpath
 		else:
 			self.payload_exportpath = self.output
+		# Store exported payloads by content:
+		self.export_store = export_store
+		if self.export_store:
+			self.attachment_init()
 		# Display errors
 		self.quiet = quiet
 		# from or to filter
 		self.filter_or_logic = filter_or_logic
+		# Compile filters once:
+		self.ignorecase = ignorecase
+		self.fixed_strings = fixed_strings
+		self.filter_plan = FilterPlan(self.filters, filter_or_logic, ignorecase, fixed_strings)
+		# Pass mails dated in [since, until) only:
+		self.since = date_timestamp(since)
+		self.until = date_timestamp(until)
+		# Parse whole mails only after passing the filters:
+		self.scan_headers = scan_headers
+		# Read mbox files by:
+		if reader not in READERS:
+			raise ReaderUnknown(reader)
+		self.reader = reader
+		# Filter mbox files by worker processes:
+		self.jobs = max(1, jobs)
+		self.chunk_size = chunk_size
+		# Resume mbox files from checkpoints:
+		self.resume = resume
+		if self.resume:
+			self.checkpoint_init()
+		# Keep filter matches of selected headers only:
+		self.filter_recorded = set(key for key, form in self.selectors or [])
+		# Compress result mboxes, the failure file and exported text payloads:
+		if compression is not None and compression not in COMPRESSION_SUFFIXES:
+			raise CompressionUnavailable(compression)
+		self.compression = compression
+		# Keep result mboxes open between mails:
+		self.output_pool = OutputPool(max_open, buffering, compression)
+		# Write results by background threads:
+		self.writers = writers
+		self.write_queue = write_queue
+		self.writer = None
+		if self.writers > 0 and not self.caching:
+			self.writer_init()
+		# Time stages, no overhead unless enabled:
+		self.stats = None
+		self.progress = progress
+		self.stats_enabled = stats or progress > 0
+		if self.stats_enabled:
+			self.stats_init()
+
+	def stats_init(self):
+		""" Time the stages of filtering by wrapping the methods of this instance. """
+		self.stats = Stats()
+		for name in STATS_STAGES:
+			setattr(self, name, self.stats.wrap(name, getattr(self, name), self.stats_progress if name == "filter_entry" else None))
+
+	def stats_progress(self):
+		""" Write a progress message, if due. """
+		now = time.time()
+		if self.progress and now - self.stats.reported >= self.progress:
+			self.stats.reported = now
+			sys.stderr.write("progress: %s filtered, %s passed, %s failed, %.1f mails/s\n" %(self.filtered, self.passed, self.failed, self.filtered / max(now - self.stats.started, 1e-9)))
+
+	def statistics(self):
+		""" Return counters, times per stage, throughput, cache and handle pool statistics. """
+		result = {"filtered": self.filtered, "passed": self.passed, "failed": self.failed, "exported": self.exported, "stored": self.stored, "deleted": self.deleted, "visited": self.visited, "exceeded": self.exceeded}
+		if self.stats is not None:
+			result.update(self.stats.statistics())
+			elapsed = max(result["elapsed"], 1e-9)
+			result["bytes_written"] = self.output_pool.written + (self.writer.written() if self.writer is not None else 0)
+			result["mails_per_s"] = self.filtered / elapsed
+			result["mb_per_s"] = result["bytes_read"] / 1048576.0 / elapsed
+		result["cache"] = self.cache_statistics()
+		result["pool"] = self.output_pool.statistics()
+		if self.writer is not None:
+			result["writer"] = self.writer.statistics()
+		if self.dedup is not None:
+			result["dedup"] = self.dedup.statistics()
+		return result
 
 	def error(self, msg, mail):
 		""" Output an error. """
@@ -198,79 +1350,588 @@ class Filter:
 
 	def error_pipe(self, mail):
 		""" Add mail to resultset of errors. """
+		if mail is None:
+			return
 		if self.caching:
 			self.failed_mails.append(mail)
 		elif self.failure_path:
-			self.output_mail(open(os.path.normpath(self.failure_path), "a"), mail)
+			self.output_bytes(self.output_pool.handle(self.output_suffix(os.path.normpath(self.failure_path))), self.mail_serialize(mail).encode(OUTPUT_ENCODING, "surrogateescape"))
 	
 	def output_attachment(self, path, content):
 		""" Write file to path. """
 		with open(path, "w+b") as fd:
 			fd.write(content)
+		self.output_attachment_written(path)
+
+	def output_attachment_stream(self, path, payload):
+		""" Decode payload in chunks into the file path. """
+		with open(path, "w+b") as fd:
+			self.output_attachment_decode(fd, payload)
+		self.output_attachment_written(path)
+
+	def output_attachment_compress(self, path, payload):
+		""" Decode payload in chunks into the compressed file path. """
+		try:
+			with compress_open(path, "wb", self.compression) as handle:
+				for chunk in payload_chunks(payload, self.export_buffer):
+					handle.write(chunk)
+		except ValueError:
+			# Malformed encodings are decoded as lenient as before:
+			with compress_open(path, "wb", self.compression) as handle:
+				handle.write(self.payload_decode(payload))
+		self.output_attachment_written(path)
+
+	def output_suffix(self, path):
+		""" Append the suffix of the compression to path. """
+		suffix = COMPRESSION_SUFFIXES.get(self.compression, "")
+		return path if path.endswith(suffix) else path + suffix
+
+	def output_attachment_decode(self, handle, payload, hashing=False):
+		""" Decode payload in chunks into handle. Return the SHA-256 value of the decoded payload if hashing. """
+		sha = hashlib.sha256() if hashing else None
+		try:
+			for chunk in payload_chunks(payload, self.export_buffer):
+				handle.write(chunk)
+				if sha is not None:
+					sha.update(chunk)
+		except ValueError:
+			# Malformed encodings are decoded as lenient as before:
+			handle.seek(0)
+			handle.truncate()
+			data = self.payload_decode(payload)
+			handle.write(data)
+			if sha is not None:
+				sha = hashlib.sha256(data)
+		return sha.hexdigest() if sha is not None else None
+
+	def output_attachment_store(self, payload):
+		""" Decode payload into the store unless stored already, return its SHA-256 value. """
+		# Decoded and hashed at once, known payloads are discarded:
+		fd, tmp = tempfile.mkstemp(".part", ".store-", self.payload_exportpath)
+		try:
+			with os.fdopen(fd, "w+b") as handle:
+				value = self.output_attachment_decode(handle, payload, True)
+			path = self.output_attachment_path(value)
+			if os.path.exists(path):
+				os.unlink(tmp)
+				return value
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			# Atomic, a concurrent writer stores the same content:
+			os.replace(tmp, path)
+			self.output_attachment_written(path)
+			self.stored += 1
+		except:
+			if os.path.exists(tmp):
+				os.unlink(tmp)
+			raise
+		return value
+
+	def output_attachment_path(self, value):
+		""" Determine the path of a payload in the store by its SHA-256 value. """
+		levels = [value[2*level:2*level+2] for level in range(STORE_LEVELS)]
+		return os.path.normpath(os.path.join(self.payload_exportpath, *(levels + [value])))
+
+	def output_attachment_written(self, path):
+		""" Fsync exported files in batches. """
+		if self.stats is not None:
+			self.stats.bytes_exported += os.path.getsize(path)
+		if self.export_fsync > 0:
+			self.export_unsynced.append(path)
+			if len(self.export_unsynced) >= self.export_fsync:
+				self.output_attachment_sync()
+
+	def output_attachment_sync(self):
+		""" Fsync all exported files not synced yet. """
+		paths = self.export_unsynced
+		self.export_unsynced = []
+		for path in paths:
+			fd = os.open(path, os.O_RDONLY)
+			try:
+				os.fsync(fd)
+			finally:
+				os.close(fd)
+
+	def mail_serialize(self, mail):
+		""" Return email as mbox entry. """
+		handle = io.StringIO()
+		self.output_mail(handle, mail)
+		return handle.getvalue()
 
 	def output_mail(self, handle, mail):
 		""" Write email to filehandle. """
 		genr = email.generator.Generator(handle, True, 0)
+		# Keep the From line of a mbox message, the generator makes up one by the current time:
+		if isinstance(mail, mailbox.mboxMessage) and mail.get_unixfrom() is None:
+			mail.set_unixfrom("From " + mail.get_from())
 		genr.flatten(mail, True)
 		# Close mbox entry explicit:
 		handle.write("\n")	  
 
+	def output_bytes(self, handle, data):
+		""" Write bytes to a result mbox or STDOUT. """
+		if isinstance(handle, io.TextIOBase):
+			if not hasattr(handle, "buffer"):
+				handle.write(data.decode(OUTPUT_ENCODING, "surrogateescape"))
+				return
+			handle.flush()
+			handle = handle.buffer
+		handle.write(data)
+
+	def output_copy(self, handle, fd, offset, length):
+		""" Copy bytes of a mbox file to a result mbox in the kernel, return the number of bytes copied. """
+		if fcntl is None or not isinstance(handle, io.BufferedWriter):
+			return 0
+		handle.flush()
+		out = handle.fileno()
+		# Kernel copies refuse files opened for appending:
+		flags = fcntl.fcntl(out, fcntl.F_GETFL)
+		fcntl.fcntl(out, fcntl.F_SETFL, flags & ~os.O_APPEND)
+		try:
+			os.lseek(out, 0, os.SEEK_END)
+			return file_copy(fd, out, offset, length)
+		finally:
+			fcntl.fcntl(out, fcntl.F_SETFL, flags)
+			handle.seek(0, os.SEEK_END)
+
 			
 	def filter_mbox(self, obj):
-		""" Filter a mbox file or mailbox.mbox instance. """
+		""" Filter a mbox file, compressed or not, mailbox.mbox, MmapMbox instance or list of mails. """
+		checkpoint = None
 		if isinstance(obj, str):
-			if os.path.isfile(obj):
-				obj = mailbox.mbox(obj)
-		for mail in obj:
-			self.filter_mail(mail)
+			if os.path.isfile(obj) and mbox_compression(obj) is not None:
+				if self.stats is not None:
+					self.stats.bytes_read += os.path.getsize(obj)
+				obj = self.mbox_open(obj)
+			elif os.path.isfile(obj):
+				start, stop = 0, None
+				if self.resume:
+					checkpoint = self.checkpoint_start(obj)
+					start, stop = checkpoint[1:]
+				if self.jobs > 1 and not self.caching:
+					self.filter_chunks(mbox_chunks(obj, self.chunk_size, start, stop))
+					return self.checkpoint_save(checkpoint)
+				if self.stats is not None:
+					self.stats.bytes_read += (os.path.getsize(obj) if stop is None else stop) - start
+				obj = self.mbox_open(obj, start, stop)
+		try:
+			for entry in self.mbox_entries(obj):
+				self.filter_entry(entry)
+		finally:
+			if isinstance(obj, (mailbox.mbox, MmapMbox, StreamMbox)):
+				obj.close()
+			self.close()
+		self.checkpoint_save(checkpoint)
+
+	def filter_many(self, paths):
+		""" Filter many mbox files, spread over worker processes if jobs > 1. """
+		if self.jobs == 1 or self.caching:
+			for path in paths:
+				self.filter_mbox(path)
+			return
+		# Compressed files can't be split into chunks, consecutive files are split together in the order given:
+		for chunked, group in itertools.groupby(paths, lambda path: os.path.isfile(path) and mbox_compression(path) is None):
+			if not chunked:
+				for path in group:
+					self.filter_mbox(path)
+				continue
+			checkpoints = [self.checkpoint_start(path) if self.resume else (path, 0, None) for path in group]
+			self.filter_chunks(itertools.chain.from_iterable(mbox_chunks(path, self.chunk_size, start, stop) for path, start, stop in checkpoints))
+			if self.resume:
+				for checkpoint in checkpoints:
+					self.checkpoint_save(checkpoint)
+
+	def filter_chunks(self, chunks):
+		""" Filter chunks of mbox files by worker processes, output results in order. """
+		# Workers get a pickled copy without files, connections and writer threads, forked ones would share them:
+		pool = multiprocessing.get_context("spawn").Pool(self.jobs, worker_init, (self,))
+		try:
+			pending = collections.deque()
+			for chunk in chunks:
+				if self.stats is not None:
+					self.stats.bytes_read += chunk[2] - chunk[1]
+				pending.append(pool.apply_async(worker_filter_chunk, (chunk,)))
+				# Bound the results waiting for output:
+				if len(pending) >= 2 * self.jobs:
+					self.filter_chunk_merge(*pending.popleft().get())
+			while pending:
+				self.filter_chunk_merge(*pending.popleft().get())
+			pool.close()
+		finally:
+			pool.terminate()
+			pool.join()
+			self.close()
+
+	def filter_chunk_merge(self, counters, records):
+		""" Index and output the results of a chunk filtered by a worker. """
+		self.filtered += counters["filtered"]
+		self.exported += counters["exported"]
+		self.deleted += counters["deleted"]
+		self.stored += counters["stored"]
+		self.visited += counters["visited"]
+		self.exceeded += counters["exceeded"]
+		if self.stats is not None and "stats" in counters:
+			self.stats.merge(counters["stats"])
+		for row, outputs, msg, text, attachments, digest in records:
+			self.mail_start()
+			for attachment in attachments:
+				self.attachment_add(attachment)
+			try:
+				if row is not None:
+					self.index_insert(*row)
+				elif digest is not None:
+					self.dedup_check(digest)
+			except sqlite3.IntegrityError:
+				msg = "can't add mail twice to result index"
+			except MailDuplicate as excp:
+				msg = str(excp)
+			if msg is not None:
+				self.mail_fail(msg, email.message_from_string(text) if text is not None else None)
+				continue
+			for key, data in outputs:
+				self.resultset_write(key, data)
+			self.mail_passed()
+
+	def mail_start(self):
+		""" Number the current mail, its write items carry the number. """
+		self.mail_seq += 1
+		self.mail_counted = False
+
+	def mail_passed(self):
+		""" Count the current mail as passed, unless it was rejected already. """
+		if self.mail_seq in self.mail_rejected:
+			return
+		self.passed += 1
+		self.mail_counted = True
+
+	def mail_fail(self, msg, mail):
+		""" Fail the current mail, unless it was rejected already. """
+		if self.mail_seq in self.mail_rejected:
+			return
+		self.mail_rejected.add(self.mail_seq)
+		self.error(msg, mail)
+
+	def mail_reject(self, seq, msg, mail):
+		""" Fail the mail of sequence number seq once, after it passed the filters. """
+		if seq in self.mail_rejected:
+			return
+		self.mail_rejected.add(seq)
+		# The current mail is not counted as passed yet:
+		if seq != self.mail_seq or self.mail_counted:
+			self.passed -= 1
+		self.error(msg, mail)
+
+	def worker_collect(self):
+		""" Collect results instead of writing them, while running in a worker process. """
+		self.index_add = self.worker_index_add
+		self.dedup_add = self.worker_dedup_add
+		self.resultset_output = self.worker_resultset_output
+		self.error = self.worker_error
+		self.attachment_add = self.worker_attachment_add
+		# Times are reported to the parent process:
+		self.progress = 0
+		if self.stats_enabled:
+			self.stats_init()
+
+	def worker_filter(self, entries):
+		""" Filter entries, return counters and a record per passed or failed mail. """
+		records = []
+		self.filtered = self.passed = self.failed = self.exported = self.deleted = self.stored = self.visited = self.exceeded = 0
+		for entry in entries:
+			self.worker_record = [None, [], None, None, [], None]
+			passed, failed = self.passed, self.failed
+			self.filter_entry(entry)
+			if self.passed > passed or self.failed > failed:
+				records.append(tuple(self.worker_record))
+		counters = {"filtered": self.filtered, "exported": self.exported, "deleted": self.deleted, "stored": self.stored, "visited": self.visited, "exceeded": self.exceeded}
+		if self.stats is not None:
+			counters["stats"] = self.stats.dump()
+		return counters, records
+
+	def worker_index_add(self, mail):
+		""" Keep the index row of a mail for the parent process. """
+		self.worker_record[0] = (self.index_row(mail), self.fulltext_row(mail))
+
+	def worker_dedup_add(self, mail):
+		""" Keep the digest of a mail for the parent process. """
+		self.worker_record[5] = self.index_digest(mail)
+
+	def worker_resultset_output(self, key, mail):
+		""" Keep the serialized mail for the parent process. """
+		self.worker_record[1].append((key, self.resultset_data(mail)))
+
+	def worker_attachment_add(self, row):
+		""" Keep the stored payload of a mail for the parent process. """
+		self.worker_record[4].append(row)
+
+	def worker_error(self, msg, mail):
+		""" Keep the error and the serialized mail for the parent process. """
+		self.failed += 1
+		self.worker_record[2] = msg
+		try:
+			self.worker_record[3] = self.mail_serialize(mail) if mail is not None else None
+		except:
+			self.worker_record[3] = None
+
+	def writer_init(self):
+		""" Hand result sets, payloads and index rows to background writer threads. """
+		self.writer = Writer(self.writers, self.write_queue, self.output_pool.max_open, self.output_pool.buffering, self.compression)
+		self.resultset_write = self.writer_resultset_write
+		self.payload_write = self.writer_payload_write
+		self.index_flush = self.writer_index_flush
+		self.attachment_add = self.writer_attachment_add
+		self.attachment_flush = self.writer_attachment_flush
+
+	def writer_submit(self, route, mail, function, *args):
+		""" Queue a write item of the current mail, report failures of former items first. """
+		if self.writer.failures:
+			self.writer_failures()
+		self.writer.submit(route, self.mail_seq, mail, function, *args)
+
+	def writer_failures(self):
+		""" Report failed write items, a passed mail fails once. """
+		while self.writer.failures:
+			seq, msg, mail = self.writer.failures.popleft()
+			mail = email.message_from_bytes(mail) if isinstance(mail, bytes) else mail
+			if seq is None:
+				self.error(msg, mail)
+			else:
+				self.mail_reject(seq, msg, mail)
+
+	def writer_join(self):
+		""" Wait until all write items are written and stop the threads, then report their failures. """
+		try:
+			self.writer.close()
+		finally:
+			self.writer_failures()
+
+	def writer_resultset_write(self, key, data):
+		""" Queue the bytes of a mail for a result set. """
+		self.writer_submit(key, data, self.writer_output, key, data)
+
+	def writer_output(self, pool, key, data):
+		""" Write the bytes of a mail to a result set, in a writer thread. """
+		self.output_bytes(sys.stdout if key is None else pool.handle(self.resultset_path(key)), data)
+
+	def writer_payload_write(self, payload, mail, name):
+		""" Queue a payload for export. """
+		self.writer_submit(None, mail, self.writer_payload, payload, name)
+
+	def writer_payload(self, pool, payload, name):
+		""" Write a payload, in the first writer thread. """
+		if self.export_store:
+			self.writer_attachment(pool, [name + (self.output_attachment_store(payload),)])
+		else:
+			self.payload_file(payload, name)
+
+	def writer_attachment_add(self, row):
+		""" Queue a stored payload for the result index. """
+		self.writer_submit(None, None, self.writer_attachment, [row])
+
+	def writer_attachment_flush(self):
+		""" Queue the commit of waiting stored payloads. """
+		self.writer_submit(None, None, self.writer_attachment_commit)
+
+	def writer_attachment(self, pool, rows):
+		""" Add stored payloads, in the first writer thread. """
+		self.writer.attachment_rows.extend(rows)
+		if len(self.writer.attachment_rows) >= self.index_batch:
+			self.writer_attachment_commit(pool)
+
+	def writer_attachment_commit(self, pool):
+		""" Commit waiting stored payloads, in the first writer thread. """
+		rows = self.writer.attachment_rows
+		self.writer.attachment_rows = []
+		self.attachment_commit(self.writer_db(), rows)
+
+	def writer_index_flush(self):
+		""" Queue waiting rows for the result index. """
+		rows, texts, seqs = self.index_take()
+		if rows:
+			self.index_queued.update(row[0] for row in rows)
+			self.writer_submit(None, None, self.writer_index_commit, rows, texts, seqs)
+
+	def writer_index_commit(self, pool, rows, texts, seqs):
+		""" Commit index rows, in the first writer thread. """
+		try:
+			rejected = self.index_commit(self.writer_db(), rows, texts)
+		finally:
+			self.index_queued.difference_update(row[0] for row in rows)
+		for row in rejected:
+			self.writer.failures.append((seqs[row[0]], "can't add mail twice to result index", None))
+
+	def writer_db(self):
+		""" Return the connection of the writer threads to the result index. """
+		if self.writer.db is None:
+			self.writer.db = self.index_open(False)
+		return self.writer.db
+
+	def __getstate__(self):
+		""" Drop open files and connections, when copied to a worker process. """
+		state = self.__dict__.copy()
+		for name in ["db", "output_pool", "index_rows", "index_pending", "fulltext_rows", "attachment_rows", "entry", "stats", "writer", "dedup"] + STATS_STAGES + WRITER_METHODS:
+			state.pop(name, None)
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.output_pool = OutputPool(1, compression=self.compression)
+		self.stats = None
+		self.writer = None
+
+	def mbox_open(self, path, start=0, stop=None):
+		""" Open a mbox file by the configured reader, memory mapped if a byte range is given. Compressed files are streamed. """
+		compression = mbox_compression(path)
+		if compression is not None:
+			return StreamMbox(path, compression, self.jobs, self.chunk_size)
+		if self.reader == "mmap" or start or stop is not None:
+			return MmapMbox(path, start, stop)
+		return mailbox.mbox(path)
+
+	def mbox_entries(self, obj):
+		""" Yield entries of a mbox. """
 		if isinstance(obj, mailbox.mbox):
-			obj.close()
+			return (MboxEntry(obj, key) for key in obj.iterkeys())
+		if isinstance(obj, (MmapMbox, StreamMbox)):
+			return iter(obj)
+		return (MailEntry(mail) for mail in obj)
+
+	def close(self):
+		""" Flush the result index and close all result mboxes. """
+		try:
+			if self.indexing:
+				self.index_flush()
+			if self.export_store:
+				self.attachment_flush()
+			if self.writer is not None:
+				self.writer_join()
+			self.output_attachment_sync()
+		finally:
+			self.output_pool.close()
 
 	def filter_mail(self, mail):
-		""" Filter a single mail. """
+		""" Filter a single mail, return True if it passed. """
+		return self.filter_entry(MailEntry(mail)) is not None
+
+	def filter_one(self, mail, output=False):
+		""" Filter a mail as stage of a pipeline, return it if it passed, else None. """
+		return self.filter_entry(MailEntry(mail), output)
+
+	def filter_stream(self, obj, output=False):
+		""" Yield the mails of a mbox file, mailbox.mbox, MmapMbox instance or iterable of mails passing the filters. """
+		if isinstance(obj, str):
+			obj = self.mbox_open(obj)
+		try:
+			for entry in self.mbox_entries(obj):
+				mail = self.filter_entry(entry, output)
+				if mail is not None:
+					yield mail
+		finally:
+			if isinstance(obj, (mailbox.mbox, MmapMbox, StreamMbox)):
+				obj.close()
+			self.close()
+
+	def filter_entry(self, entry, output=True):
+		""" Filter a mail by its header, parse the whole mail only if it passes. Return the passed mail or None.
+			Without output the mail is neither indexed nor added to a result set, nor are its payloads exported or removed. """
+		mail = None
+		# Locate the mail in the result index:
+		self.entry = entry
+		self.modified = False
+		self.mail_start()
 		try:
 			self.filtered += 1
-			if self.filter_mail_pass(mail):
-				if self.export_payload or self.reduce_payload:
+			headers = self.mail_parse(entry, self.scan_headers)
+			if self.filter_mail_pass(headers):
+				mail = self.mail_parse(entry)
+				# The header of the parsed mail is decoded already:
+				if self.view is not None and self.view.mail is headers:
+					self.view.mail = mail
+				if output and (self.export_payload or self.reduce_payload):
 					self.payload_parse(mail)
-				if self.indexing: # and not caching # disables indexing
-					self.index_add(mail)
-				self.resultset_add(mail)
-				self.passed += 1
+				if output:
+					if self.indexing: # and not caching # disables indexing
+						self.index_add(mail)
+					elif self.dedup_mode:
+						self.dedup_add(mail)
+					self.resultset_add(mail)
+				self.mail_passed()
+				return mail
 		except sqlite3.IntegrityError as excp:
-			self.error("can't add mail twice to result index", mail)
+			self.mail_fail("can't add mail twice to result index", mail)
 		except:
 			#traceback.print_tb(sys.exc_info()[2])
-			self.error(str(sys.exc_info()[1]), mail)
+			msg = str(sys.exc_info()[1])
+			self.mail_fail(msg, mail if mail is not None else self.error_message(entry))
+		return None
+
+	def error_message(self, entry):
+		""" Parse the entry of a mail failed before being parsed for the failure log. None if not logged or not parseable. """
+		if self.quiet or not (self.caching or self.failure_path):
+			return None
+		try:
+			return entry.message()
+		except Exception:
+			return None
+
+	def mail_parse(self, entry, headers=False):
+		""" Parse the header block or the whole mail of an entry. """
+		return entry.headers() if headers else entry.message()
 
 	def filter_mail_pass(self, mail):
-		""" Apply all filters. """
+		""" Apply all filters, stop as soon as the result is decided. """
 		self.filter_matches = {}
-		boolean = True
-		if self.filter_or_logic:
-				boolean = False
-		for header, regexp in self.filters:
+		if (self.since is not None or self.until is not None) and not self.filter_date_range(mail):
+			return False
+		boolean = not self.filter_or_logic
+		for matcher in self.filter_plan:
+			record = matcher.header in self.filter_recorded
+			# Decided by or logic, matches are needed for sorting only:
+			if boolean and self.filter_or_logic and not record:
+				continue
 			inner_boolean = False
-			for header_value in header_values(header, mail):
-				# True if any header part is true:  
-				inner_boolean |= self.filter_item_pass(header, regexp, header_value)
+			for header_value in self.header_values(matcher.header, mail):
+				# True if any header part is true:
+				if matcher.search(header_value):
+					inner_boolean = True
+					if not record:
+						break
+					self.filter_matches_add(matcher.header, header_value)
 			# True if any filter items are true:
 			if self.filter_or_logic:
 				boolean |= inner_boolean
-			# True if all filter items are true:
-			else:
-				boolean &= inner_boolean
+			# False if any filter item is false:
+			elif not inner_boolean:
+				return False
 		return boolean
-				 
+
 	def filter_item_pass(self, header, regexp, strg):
-		""" Apply filter. """
-		try:
-			if re.search(regexp, strg):#, flags=re.IGNORECASE):
-				self.filter_matches_add(header, strg)
-				return True
+		""" Apply a single filter to strg, keep the match. filter_mail_pass matches by the compiled filter plan instead. """
+		if FilterMatcher(header, [regexp], self.ignorecase, self.fixed_strings).search(strg):
+			self.filter_matches_add(header, strg)
+			return True
+		return False
+
+	def filter_date_range(self, mail):
+		""" True if the Date of mail is in [since, until), regardless of the time zone. """
+		timestamp = header_timestamp(self.header_values("Date", mail)[0])
+		if timestamp is None:
 			return False
-		except:
-			raise RegularExpressionError(regexp)
+		return (self.since is None or timestamp >= self.since) and (self.until is None or timestamp < self.until)
+
+	def mail_view(self, mail):
+		""" Return the decoded headers of mail. """
+		view = self.view
+		if view is None or view.mail is not mail:
+			view = self.view = MailView(mail, self.view_statistics)
+		return view
+
+	def header_values(self, header, mail):
+		""" Split header of mail into a list, decoded once per mail. """
+		return self.mail_view(mail).values(header)
+
+	def cache_statistics(self):
+		""" Return hit and miss counts of the decoded headers per mail and across mails. """
+		return {"view": dict(self.view_statistics), "decode": header_decode_cache.statistics(), "address": header_address_cache.statistics(), "spool": self.spool_budget.statistics(), "date_format": date_format_cache.statistics(), "date_timestamp": date_timestamp_cache.statistics()}
 
 	def filter_matches_add(self, key, value):
 		""" Keep match of filter."""
@@ -283,46 +1944,59 @@ class Filter:
 		""" Decode the payload. """
 		return payload.get_payload(decode=1)
 
-	def payload_delete(self, mail):
-		""" Remove makred payloads from mail. """
-		offset = 0
-		for idx in sorted(self.delete_marked):
-			del mail.get_payload()[idx+offset]
-			offset -= 1
-			self.deleted += 1
-		self.delete_marked = []
-
-	def payload_export(self, payload, mail):
+	def payload_export(self, payload, mail, index):
 		""" Write payload to file. """
 		fname = header_decode(payload.get_filename() or "")
 		if fname:
-			path = os.path.normpath("%s/%s" % (self.payload_exportpath, ".".join([email.utils.unquote(header_decode(mail["Message-ID"])), "%02d" %self.payload_index(payload, mail), fname])))
-			self.output_attachment(path, self.payload_decode(payload))
+			mssgid = email.utils.unquote(self.mail_view(mail).decode("Message-ID"))
+			self.payload_write(payload, mail, (mssgid, payload_index_format(index), fname))
 			self.exported += 1
 
-	def payload_handle(self, payload, mail):
-		""" Handle payload by application logic and mime type. """
+	def payload_write(self, payload, mail, name):
+		""" Write payload to the store or to a file named by Message-ID, formatted index and filename. """
+		if self.export_store:
+			self.attachment_add(name + (self.output_attachment_store(payload),))
+		else:
+			self.payload_file(payload, name)
+
+	def payload_file(self, payload, name):
+		""" Write payload to a file named by Message-ID, formatted index and filename, text compressed if configured. """
+		if self.compression is not None and payload.get_content_maintype() == "text":
+			self.output_attachment_compress(self.output_suffix(self.payload_path(name)), payload)
+		else:
+			self.output_attachment_stream(self.payload_path(name), payload)
+
+	def payload_path(self, name):
+		""" Return the path of an exported payload by Message-ID, formatted index and filename. """
+		return os.path.normpath("%s/%s" % (self.payload_exportpath, ".".join(name)))
+
+	def payload_handle(self, payload, mail, index):
+		""" Handle payload by application logic and mime type, return True if it is to be removed. """
 		if self.payload_is_handleable(payload):
 			if self.export_payload:
-				self.payload_pipe(payload, mail)
+				self.payload_pipe(payload, mail, index)
 			if self.reduce_payload:
-				# Mark email as deleted:
-				self.delete_marked.append(self.payload_index(payload, mail))
-
-	def payload_index(self, payload, mail):
-		""" Return index of payload """
-		return mail.get_payload().index(payload)
+				self.deleted += 1
+				return True
+		return False
 
-	def payload_parse(self, mail):
-		""" Handle all payloads of the mail. """
-		if mail.is_multipart():
-			for payload in mail.get_payload():
+	def payload_parse(self, mail, part=None, index=()):
+		""" Handle all payloads of the mail, nested ones by their path of indexes. """
+		part = mail if part is None else part
+		if part.is_multipart():
+			payloads = part.get_payload()
+			kept = []
+			for idx, payload in enumerate(payloads):
+				self.visited += 1
 				if payload.get_content_maintype() == "multipart":
-					self.payload_parse(payload)
-				else:
-					self.payload_handle(payload, mail)
-			# Post deletion of payloads:
-			self.payload_delete(mail)
+					self.payload_parse(mail, payload, index + (idx,))
+				elif self.payload_handle(payload, mail, index + (idx,)):
+					continue
+				kept.append(payload)
+			# Rebuild the list of payloads once:
+			if len(kept) < len(payloads):
+				part.set_payload(kept)
+				self.modified = True
 
 	def payload_is_handleable(self, payload):
 		""" Select payload for processing by mime type. """
@@ -330,18 +2004,20 @@ class Filter:
 			return True
 		return False
 
-	def payload_pipe(self, payload, mail):
+	def payload_pipe(self, payload, mail, index):
 		""" Pipe payload either to file or cache. """
 		if self.caching:
 			self.exported_payloads.append(self.payload_decode(payload))
 		else:
-			self.payload_export(payload, mail)
+			self.payload_export(payload, mail, index)
 
 	def resultset_add(self, mail):
 		""" Append mail to a result set. """
+		self.resultset_cached = None
+		self.resultset_serialized = (None, None)
 		if self.sort_keys_generate(mail) > 0:
-			for key in self.sort_keys:
-				self.resultset_pipe(key, mail)
+			for parts in self.sort_keys:
+				self.resultset_pipe(self.sort_key_separator.join(parts), mail)
 		else:
 			self.resultset_pipe(None, mail)
 
@@ -353,76 +2029,885 @@ class Filter:
 			self.resultset_output(key, mail)
 
 	def resultset_cache(self, key, mail):
-		""" Cache results """
-		self.passed_mails.append(mail)
-		if key in self.resultset:
-			self.resultset[key].append(mail)
-		else:
-			self.resultset[key]=[mail]
+		""" Cache a mail once, reference it by key. """
+		if self.resultset_cached is not mail:
+			self.passed_mails.append(mail)
+			self.resultset_cached = mail
+		if key not in self.resultset:
+			self.resultset[key] = SpoolView(self.passed_mails)
+		self.resultset[key].append(len(self.passed_mails) - 1)
 
 	def resultset_output(self, key, mail):
-		""" Write mail to a result set. """
-		handle = sys.stdout
-		if key is not None:
-			handle = open(os.path.normpath(self.output + "/" + key + ".mbox"), "a")
-		self.output_mail(handle, mail)
+		""" Write mail to a result set, large unmodified mails are copied from their mbox file. """
+		entry = self.resultset_entry(mail)
+		source = entry.source() if entry is not None else None
+		if source is not None and source[2] >= COPY_MIN and self.writer is None and self.compression is None:
+			copied = self.output_copy(self.resultset_handle(key), *source)
+			if copied == source[2]:
+				return
+			if copied:
+				return self.resultset_write(key, self.resultset_data(mail)[copied:])
+		self.resultset_write(key, self.resultset_data(mail))
+
+	def resultset_write(self, key, data):
+		""" Write the bytes of a mail to a result set. """
+		self.output_bytes(self.resultset_handle(key), data)
+
+	def resultset_entry(self, mail):
+		""" Return the entry of mail, if its raw bytes may be written. """
+		entry = self.entry
+		if self.passthrough and not self.modified and entry is not None and entry.mail is mail:
+			return entry
+		return None
+
+	def resultset_data(self, mail):
+		""" Return the bytes of a mail once for all of its result sets, raw if unmodified. """
+		if self.resultset_serialized[0] is not mail:
+			entry = self.resultset_entry(mail)
+			data = entry.raw() if entry is not None else None
+			if data is None:
+				data = self.mail_serialize(mail).encode(OUTPUT_ENCODING, "surrogateescape")
+			elif not data.endswith(b"\n\n"):
+				# The last mail of a mbox file may lack the closing blank line:
+				data += b"\n"
+			self.resultset_serialized = (mail, data)
+		return self.resultset_serialized[1]
+
+	def resultset_handle(self, key):
+		""" Return the handle of a result set. """
+		if key is None:
+			return sys.stdout
+		return self.output_pool.handle(self.resultset_path(key))
+
+	def resultset_path(self, key):
+		""" Return the path of a result set. """
+		return self.output_suffix(os.path.normpath(self.output + "/" + key + ".mbox"))
 
 	def sort_keys_generate(self, mail):
-		""" Determine the sort keys for a mail. """
+		""" Determine the sort keys for a mail as tuples of key parts. """
 		# Reset sort keys for every mail:
 		self.sort_keys = []
+		parts = []
 		for key, form in self.selectors:
 			# Sort by filter matches only (1:1):
 			if key in self.filter_matches.keys():
-				self.sort_keys_add(key, form, self.filter_matches[key])
+				parts.append(self.sort_keys_add(key, form, self.filter_matches[key]))
 			# Sort by all header parts (1:N):
 			else:
-				self.sort_keys_add(key, form, header_values(key, mail))
+				parts.append(self.sort_keys_add(key, form, self.header_values(key, mail)))
+		if parts:
+			count = 1
+			for part in parts:
+				count *= len(part)
+			if self.max_keys and count > self.max_keys:
+				self.exceeded += 1
+				raise SortKeysExceeded(count)
+			# Generates n*m sort keys for n and m key parts:
+			self.sort_keys = list(itertools.product(*parts))
 		return len(self.sort_keys)
 
 	def sort_keys_add(self, key, form, values):
-		""" Append key part to sort keys (generates n*m sort keys for n and m key parts)."""
-		new_keys = []
+		""" Return the distinct, interned key parts of header values. """
+		key_parts = []
 		for value in values:
 			key_value = header_format(key, value, form) 
 			# revoke empty key parts:
 			if len(key_value) > 0:
-				# No keys existing:
-				if len(self.sort_keys) == 0:
-					new_keys.append(key_value)
-				else:
-					for sort_key in self.sort_keys:
-						new_keys.append(sort_key + self.sort_key_separator + key_value)
+				key_parts.append(sys.intern(key_value))
 			else:
 				raise EmptyKeyPart()
-		# Reset to extended set of sort keys:
-		self.sort_keys = new_keys
+		return list(dict.fromkeys(key_parts))
 	  
+	def index_connect(self):
+		""" Connect to the result index database once. """
+		if getattr(self, "db", None) is None:
+			self.db = self.index_open()
+
+	def index_open(self, check_same_thread=True):
+		""" Open a connection to the result index database. """
+		db = sqlite3.connect(self.index_path(), check_same_thread=check_same_thread)
+		if self.journal_mode:
+			db.execute("PRAGMA journal_mode=%s" %self.journal_mode)
+		if self.synchronous:
+			db.execute("PRAGMA synchronous=%s" %self.synchronous)
+		return db
+
 	def index_init(self):
 		""" Initialize the result index database. """
-		self.db = sqlite3.connect(self.index_path())
+		self.index_connect()
 		self.db.execute('CREATE TABLE IF NOT EXISTS Mails ("MD5-Value" TEXT PRIMARY KEY, "Message-ID" TEXT, "From" TEXT NOT NULL, "To" TEXT NOT NULL, "Cc" TEXT, "Bcc", TEXT, Date TEXT NOT NULL, "In-Reply-To" TEXT, Subject TEXT)');
+		# Location and time of mails, added to databases of former versions:
+		columns = [row[1] for row in self.db.execute("PRAGMA table_info(Mails)")]
+		for column, kind in [("Mbox", "TEXT"), ("Offset", "INTEGER"), ("Length", "INTEGER"), ("Timestamp", "REAL")]:
+			if column not in columns:
+				self.db.execute("ALTER TABLE Mails ADD COLUMN %s %s" %(column, kind))
+		# Binary MD5 values of mails, filled in rows added by former versions:
+		if "Digest" not in columns:
+			self.db.execute("ALTER TABLE Mails ADD COLUMN Digest BLOB")
+		self.db.create_function("mboxfilter_digest", 1, binascii.unhexlify)
+		self.db.execute('UPDATE Mails SET Digest = mboxfilter_digest("MD5-Value") WHERE Digest IS NULL')
+		self.db.execute('CREATE INDEX IF NOT EXISTS "Mails-Timestamp" ON Mails (Timestamp)')
+		self.db.execute('CREATE INDEX IF NOT EXISTS "Mails-Mbox" ON Mails (Mbox, Offset)')
+		self.db.execute('CREATE TABLE IF NOT EXISTS Addresses ("MD5-Value" TEXT NOT NULL, Header TEXT NOT NULL, Value TEXT NOT NULL, Address TEXT NOT NULL)')
+		# Distinct values of a header field and the mails of a value, by one index:
+		self.db.execute('DROP INDEX IF EXISTS "Addresses-Address"')
+		self.db.execute('CREATE INDEX IF NOT EXISTS "Addresses-Header" ON Addresses (Header, Value, Address)')
+		self.db.execute('CREATE INDEX IF NOT EXISTS "Addresses-MD5-Value" ON Addresses ("MD5-Value")')
+		if self.fulltext:
+			try:
+				self.db.execute('CREATE VIRTUAL TABLE IF NOT EXISTS Fulltext USING fts5("MD5-Value" UNINDEXED, Subject, Body)')
+			except sqlite3.OperationalError as excp:
+				raise FulltextUnavailable(excp)
+		self.db.commit()
+		# Rows waiting for the next commit:
+		self.index_rows = []
+		# Full-text rows of the waiting rows by MD5 value:
+		self.fulltext_rows = {}
+		# Sequence numbers of the mails of the waiting rows by MD5 value:
+		self.index_pending = {}
+		# MD5 values of the rows handed to a writer thread:
+		self.index_queued = set()
+		# Time of the last commit:
+		self.index_flushed = time.time()
 
 	def index_add(self, mail):
 		""" Add mail header to result index. """
-		self.db.execute('INSERT INTO Mails ("MD5-Value", "Message-ID", "From", "To", "Cc", "Bcc", Date, "In-Reply-To", Subject) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (self.index_md5_value(mail), email.utils.unquote(header_decode(mail['Message-ID'])), header_decode(mail['From']), header_decode(mail['To']), header_decode(mail['CC']), header_decode(mail['BCC']), header_decode(mail['Date']), email.utils.unquote(header_decode(mail['In-Reply-To'])), header_decode(mail['Subject'])))
+		self.index_insert(self.index_row(mail), self.fulltext_row(mail))
+
+	def index_seen(self, md5):
+		""" Return True if a mail of MD5 value md5 is in the result index or waits for it. """
+		return md5 in self.index_pending or md5 in self.index_queued or self.db.execute('SELECT 1 FROM Mails WHERE "MD5-Value" = ?', (md5,)).fetchone() is not None
+
+	def dedup_init(self, mode):
+		""" Keep the digests of passed mails in memory, preloaded from the result index.
+			Without indexing mode "bloom" keeps a set, hits of a Bloom filter are checked in the result index. """
+		if mode is None:
+			mode = "bloom" if self.indexing else False
+		self.dedup_mode = mode
+		self.dedup = None
+		if not mode:
+			return
+		count = 0
+		if self.indexing:
+			count, = self.db.execute("SELECT COUNT(*) FROM Mails").fetchone()
+		# Hits of a Bloom filter are checked in the index, else digests are kept exactly:
+		self.dedup = Dedup(max(self.dedup_capacity, 2 * count), mode == "set" or not self.indexing)
+		if self.indexing:
+			for digest, in self.db.execute("SELECT Digest FROM Mails"):
+				self.dedup.add(digest)
+
+	def dedup_add(self, mail):
+		""" Reject mail, if a mail with the same digest passed before. """
+		self.dedup_check(self.index_digest(mail))
+
+	def dedup_check(self, digest, md5=None):
+		""" Raise IntegrityError if a mail of digest passed before, MailDuplicate without indexing, else remember digest.
+			Mails in doubt are looked up by MD5 value md5 in the result index. """
+		dedup = self.dedup
+		seen = dedup.seen(digest) if dedup is not None else None
+		if seen is None:
+			seen = md5 is not None and self.index_seen(md5)
+		if seen:
+			if dedup is not None:
+				dedup.duplicates += 1
+			if not self.indexing:
+				raise MailDuplicate(binascii.hexlify(digest).decode("ascii"))
+			raise sqlite3.IntegrityError("UNIQUE constraint failed: Mails.MD5-Value")
+		if dedup is not None:
+			dedup.add(digest)
+
+	def fulltext_row(self, mail):
+		""" Return the row of a mail in the full-text index, None if not indexed. """
+		if not self.fulltext:
+			return None
+		texts = []
+		for part in mail.walk():
+			if part.get_content_type() == "text/plain" and not part.get_filename():
+				payload = part.get_payload(decode=True) or b""
+				texts.append(payload_text(payload, part.get_content_charset()) if isinstance(payload, bytes) else payload)
+		return (self.index_md5_value(mail), self.mail_view(mail).decode("Subject"), "\n".join(texts))
+
+	def index_row(self, mail):
+		""" Return the row of a mail in the result index, its digest is the binary MD5 value. """
+		view = self.mail_view(mail)
+		location = self.entry.location() if self.entry is not None else None
+		md5 = self.index_md5_value(mail)
+		return (md5, email.utils.unquote(view.decode('Message-ID')), view.decode('From'), view.decode('To'), view.decode('CC'), view.decode('BCC'), view.decode('Date'), email.utils.unquote(view.decode('In-Reply-To')), view.decode('Subject')) + (location or (None, None, None)) + (header_timestamp(view.decode('Date')), binascii.unhexlify(md5))
+
+	def index_insert(self, row, text=None):
+		""" Add a row and its full-text row to the result index. """
+		# Reject duplicates before the mail reaches any result set:
+		self.dedup_check(row[-1], row[0])
+		self.index_pending[row[0]] = self.mail_seq
+		self.index_rows.append(row)
+		if text is not None:
+			self.fulltext_rows[row[0]] = text
+		if len(self.index_rows) >= self.index_batch or time.time() - self.index_flushed >= self.index_interval:
+			self.index_flush()
+
+	def index_flush(self):
+		""" Commit waiting rows to the result index in one transaction. """
+		rows, texts, seqs = self.index_take()
+		# Mails of rows added by another writer meanwhile passed already:
+		for row in self.index_commit(self.db, rows, texts):
+			self.mail_reject(seqs[row[0]], "can't add mail twice to result index", None)
+
+	def index_take(self):
+		""" Return and reset the waiting rows, their full-text rows and the sequence numbers of their mails. """
+		rows = self.index_rows
+		texts = self.fulltext_rows
+		seqs = self.index_pending
+		self.index_rows = []
+		self.fulltext_rows = {}
+		self.index_pending = {}
+		self.index_flushed = time.time()
+		return rows, texts, seqs
+
+	def index_commit(self, db, rows, texts):
+		""" Insert rows and their full-text rows by connection db, return the rows rejected as duplicates. """
+		rejected = []
+		if not rows:
+			return rejected
+		sql = 'INSERT INTO Mails ("MD5-Value", "Message-ID", "From", "To", "Cc", "Bcc", Date, "In-Reply-To", Subject, Mbox, Offset, Length, Timestamp, Digest) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+		addresses = 'INSERT INTO Addresses ("MD5-Value", Header, Value, Address) VALUES (?, ?, ?, ?)'
+		fulltext = 'INSERT INTO Fulltext ("MD5-Value", Subject, Body) VALUES (?, ?, ?)'
+		try:
+			with db:
+				db.executemany(sql, rows)
+				db.executemany(addresses, index_addresses(rows))
+				if texts:
+					db.executemany(fulltext, texts.values())
+		except sqlite3.IntegrityError:
+			# Rows added by another writer meanwhile, retry one by one:
+			for row in rows:
+				try:
+					with db:
+						db.execute(sql, row)
+						db.executemany(addresses, index_addresses([row]))
+						if row[0] in texts:
+							db.execute(fulltext, texts[row[0]])
+				except sqlite3.IntegrityError:
+					rejected.append(row)
+		return rejected
+
+	def filter_index(self, paths=None, search=None):
+		""" Answer the filters from the result index, read and output only the mails matching.
+			paths restricts the query to the given mbox files, search to mails matching a full-text query.
+			Return the number of mails read. """
+		indexing, dedup_mode = self.indexing, self.dedup_mode
+		# The mails are indexed already:
+		self.indexing = self.dedup_mode = False
+		count = 0
+		try:
+			for entry in self.index_entries(paths, search):
+				count += 1
+				self.filter_entry(entry)
+		finally:
+			self.indexing, self.dedup_mode = indexing, dedup_mode
+			self.close()
+		return count
+
+	def search(self, query, paths=None):
+		""" Yield the mails matching a full-text query and the filters, read from their mbox files. """
+		indexing = self.indexing
+		self.indexing = False
+		try:
+			for entry in self.index_entries(paths, query):
+				mail = self.filter_entry(entry, False)
+				if mail is not None:
+					yield mail
+		finally:
+			self.indexing = indexing
+			self.close()
+
+	def index_entries(self, paths=None, search=None):
+		""" Yield the entries of the mails matching the filters in the result index. """
+		if getattr(self, "index_rows", None) is not None:
+			self.index_flush()
+		else:
+			self.index_init()
+		where, args = self.index_query()
+		if paths is not None:
+			locations = [os.path.abspath(path) for path in paths]
+			where.append("Mbox IN (%s)" %", ".join("?" * len(locations)))
+			args.extend(locations)
+		if search is not None:
+			if not self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'Fulltext'").fetchone():
+				raise FulltextUnavailable(self.index_path())
+			where.append('m."MD5-Value" IN (SELECT "MD5-Value" FROM Fulltext WHERE Fulltext MATCH ?)')
+			args.append(search)
+		rows = self.db.execute('SELECT "MD5-Value", Mbox, Offset, Length FROM Mails m WHERE %s ORDER BY Mbox, Offset' %" AND ".join(where), args)
+		mbox = None
+		try:
+			for md5, location, offset, length in rows.fetchall():
+				if mbox is None or mbox.location != location:
+					if mbox is not None:
+						mbox.close()
+					mbox = None
+					if not os.path.isfile(location):
+						self.error("mbox not found: %s" %location, None)
+						continue
+					mbox = MmapMbox(location)
+				entry = MmapEntry(mbox, offset, length)
+				# Skip mails of mbox files changed since indexing:
+				if offset + length > mbox.size or mbox.map[offset:offset + 5] != b"From " or self.index_md5_value(entry.headers()) != md5:
+					self.error("result index out of date: %s" %location, None)
+					continue
+				yield entry
+		finally:
+			if mbox is not None:
+				mbox.close()
+
+	def index_query(self):
+		""" Translate the filters into conditions on the result index. """
+		matchers = list(self.filter_plan)
+		self.db.create_function("mboxfilter_match", 2, lambda idx, value: bool(matchers[idx].search(value or "")))
+		# Addresses matching a filter, looked up by the index on addresses:
+		self.db.execute("CREATE TEMP TABLE IF NOT EXISTS Matches (Idx INTEGER, Address TEXT, Value TEXT)")
+		self.db.execute("DELETE FROM temp.Matches")
+		conditions = []
+		for idx, matcher in enumerate(matchers):
+			if matcher.header in INDEX_ADDRESS_FIELDS:
+				# Every distinct value is matched once, not once per mail:
+				values = self.db.execute("SELECT DISTINCT Address, Value FROM Addresses WHERE Header = ?", (matcher.header,)).fetchall()
+				self.db.executemany("INSERT INTO temp.Matches (Idx, Address, Value) VALUES (?, ?, ?)", [(idx, address, value) for address, value in values if matcher.search(value or "")])
+				conditions.append('m."MD5-Value" IN (SELECT a."MD5-Value" FROM temp.Matches t JOIN Addresses a ON a.Header = \'%s\' AND a.Value = t.Value AND a.Address = t.Address WHERE t.Idx = %s)' %(matcher.header, idx))
+			elif matcher.header == "Date" and index_date_years(matcher.patterns):
+				# Mails of the years named, matched by their Date then:
+				ranges = ["m.Timestamp >= %d AND m.Timestamp < %d" %(start - INDEX_DATE_MARGIN, stop + INDEX_DATE_MARGIN) for start, stop in index_date_years(matcher.patterns)]
+				conditions.append("((%s OR m.Timestamp IS NULL) AND mboxfilter_match(%s, m.Date))" %(" OR ".join(ranges), idx))
+			elif matcher.header in INDEX_COLUMNS:
+				conditions.append("mboxfilter_match(%s, m.%s)" %(idx, INDEX_COLUMNS[matcher.header]))
+			else:
+				raise HeaderNotIndexed(matcher.header)
 		self.db.commit()
+		where = ["Mbox IS NOT NULL"]
+		args = []
+		if conditions:
+			where.append("(%s)" %(" OR " if self.filter_or_logic else " AND ").join(conditions))
+		if self.since is not None:
+			where.append("Timestamp >= ?")
+			args.append(self.since)
+		if self.until is not None:
+			where.append("Timestamp < ?")
+			args.append(self.until)
+		return where, args
 
 	def index_md5_value(self, mail):
 		""" Determine a MD5 value for mail. """
-		return md5_value(header_decode(mail["Message-ID"]) + header_decode(mail["Date"]) + header_decode(mail["From"]) + header_decode(mail["To"]))
+		return mail_md5_value(self.mail_view(mail).decode)
+
+	def index_digest(self, mail):
+		""" Determine the binary digest of mail. """
+		return mail_digest(self.mail_view(mail).decode)
 	  
+	def checkpoint_init(self):
+		""" Initialize the table of checkpoints in the result index database. """
+		self.index_connect()
+		self.db.execute('CREATE TABLE IF NOT EXISTS Checkpoints (Path TEXT PRIMARY KEY, Inode INTEGER, Size INTEGER, Mtime REAL, Offset INTEGER, Fingerprint TEXT, Config TEXT)')
+		self.db.commit()
+
+	def checkpoint_config(self):
+		""" Determine a MD5 value for the settings affecting results. """
+		return md5_value(repr((self.filters, self.filter_or_logic, self.ignorecase, self.fixed_strings, self.selectors, self.sort_key_separator, self.indexing, self.export_payload, self.reduce_payload, self.export_store, self.fulltext, self.since, self.until, self.max_keys)))
+
+	def checkpoint_start(self, path):
+		""" Return path and the byte range of a mbox file not filtered yet. """
+		path = os.path.abspath(path)
+		stat = os.stat(path)
+		row = self.db.execute('SELECT Inode, Size, Mtime, Offset, Fingerprint, Config FROM Checkpoints WHERE Path = ?', (path,)).fetchone()
+		start = 0
+		if row and row[0] == stat.st_ino and row[3] <= stat.st_size and row[5] == self.checkpoint_config():
+			# A file unchanged since the checkpoint needs no fingerprint:
+			if (row[1], row[2]) == (stat.st_size, stat.st_mtime) or row[4] == checkpoint_fingerprint(path, row[3]):
+				start = row[3]
+		# Mails appended while filtering are left for the next run, a mail being appended too:
+		return path, start, checkpoint_stop(path, start, stat)
+
+	def checkpoint_save(self, checkpoint):
+		""" Remember the end of the byte range filtered. """
+		if checkpoint is None:
+			return
+		path, start, stop = checkpoint
+		stat = os.stat(path)
+		with self.db:
+			self.db.execute('INSERT OR REPLACE INTO Checkpoints (Path, Inode, Size, Mtime, Offset, Fingerprint, Config) VALUES (?, ?, ?, ?, ?, ?, ?)', (path, stat.st_ino, stat.st_size, stat.st_mtime, stop, checkpoint_fingerprint(path, stop), self.checkpoint_config()))
+
+	def attachment_init(self):
+		""" Initialize the table of stored payloads in the result index database. """
+		self.index_connect()
+		self.db.execute('CREATE TABLE IF NOT EXISTS Attachments ("Message-ID" TEXT, "Index" TEXT, Filename TEXT, "SHA256-Value" TEXT NOT NULL, PRIMARY KEY ("Message-ID", "Index", Filename))')
+		self.db.execute('CREATE INDEX IF NOT EXISTS "Attachments-SHA256" ON Attachments ("SHA256-Value")')
+		self.db.commit()
+		# Rows waiting for the next commit:
+		self.attachment_rows = []
+
+	def attachment_add(self, row):
+		""" Add a stored payload (Message-ID, formatted index, filename, SHA-256 value) to the result index. """
+		self.attachment_rows.append(row)
+		if len(self.attachment_rows) >= self.index_batch:
+			self.attachment_flush()
+
+	def attachment_flush(self):
+		""" Commit waiting stored payloads in one transaction. """
+		rows = self.attachment_rows
+		self.attachment_rows = []
+		self.attachment_commit(self.db, rows)
+
+	def attachment_commit(self, db, rows):
+		""" Insert stored payloads by connection db. """
+		if rows:
+			with db:
+				db.executemany('INSERT OR REPLACE INTO Attachments ("Message-ID", "Index", Filename, "SHA256-Value") VALUES (?, ?, ?, ?)', rows)
+
 	def index_path(self):
 		""" Determine the to the result index. """
 		return os.path.normpath(self.output + "/" + self.resultset_index)
 
+class Stage:
+	""" Stage of a pipeline, passes mails one by one. """
+	def filter_one(self, mail, output=False):
+		""" Return mail if it passes the stage, else None. """
+		return mail
+
+	def filter_stream(self, obj, output=False):
+		""" Yield the mails of a mbox file or iterable of mails passing the stage. """
+		try:
+			for mail in stage_mails(obj):
+				mail = self.filter_one(mail, output)
+				if mail is not None:
+					yield mail
+		finally:
+			self.close()
+
+	def filter_mbox(self, obj):
+		""" Pass all mails of obj through the stage, return the number of mails passed. """
+		return sum(1 for mail in self.filter_stream(obj, True))
+
+	def close(self):
+		pass
+
+class Pipeline(Stage):
+	""" Stages connected in a row, every mail passes all stages before the next mail is read.
+		Only the last stage outputs its results. """
+	def __init__(self, *stages):
+		self.stages = stages
+
+	def filter_one(self, mail, output=False):
+		for stage in self.stages[:-1]:
+			mail = stage.filter_one(mail)
+			if mail is None:
+				return None
+		return self.stages[-1].filter_one(mail, output)
+
+	def filter_stream(self, obj, output=False):
+		first, last = self.stages[0], len(self.stages) - 1
+		try:
+			for mail in first.filter_stream(obj, output and last == 0):
+				for idx, stage in enumerate(self.stages[1:], 1):
+					mail = stage.filter_one(mail, output and idx == last)
+					if mail is None:
+						break
+				else:
+					yield mail
+		finally:
+			self.close()
+
+	def close(self):
+		for stage in self.stages:
+			stage.close()
+
+class Union(Stage):
+	""" Passes a mail if any stage passes it, each distinct mail once. The stages don't output results. """
+	def __init__(self, *stages):
+		self.stages = stages
+		# Binary digests of the mails passed, one per distinct mail:
+		self.seen = Dedup()
+		self.duplicates = 0
+
+	def filter_one(self, mail, output=False):
+		for stage in self.stages:
+			if stage.filter_one(mail) is not None:
+				return None if stage_seen(self, mail) else mail
+		return None
+
+	def close(self):
+		for stage in self.stages:
+			stage.close()
+
+class FanOut(Union):
+	""" Passes every distinct mail to all stages, each outputs its results. Passes a mail if any stage passes it. """
+	def filter_one(self, mail, output=False):
+		if stage_seen(self, mail):
+			return None
+		passed = False
+		for stage in self.stages:
+			passed |= stage.filter_one(mail, True) is not None
+		return mail if passed else None
+
+def stage_mails(obj):
+	""" Yield the mails of a mbox file or iterable of mails. """
+	if not isinstance(obj, str):
+		yield from obj
+		return
+	mbox = mailbox.mbox(obj)
+	try:
+		yield from mbox.itervalues()
+	finally:
+		mbox.close()
+
+def stage_seen(stage, mail):
+	""" True if stage has seen mail before by its digest, remember it otherwise. """
+	digest = mail_digest(mail_decode(mail))
+	if stage.seen.seen(digest):
+		stage.duplicates += 1
+		return True
+	stage.seen.add(digest)
+	return False
+
+# Filter of a worker process:
+worker = None
+
+def worker_init(filt):
+	""" Initialize a worker process by a copy of the filter. """
+	global worker
+	worker = filt
+	worker.worker_collect()
+
+def worker_filter_chunk(chunk):
+	""" Filter a chunk (path, start, stop) of a mbox file in a worker process. """
+	mbox = MmapMbox(*chunk)
+	try:
+		return worker.worker_filter(iter(mbox))
+	finally:
+		mbox.close()
+
+def mbox_chunks(path, size=DEFAULT_CHUNK_SIZE, start=0, stop=None):
+	""" Yield chunks (path, start, stop) of about size bytes of a mbox file. """
+	mbox = MmapMbox(path, start, stop)
+	try:
+		for start, stop in mbox.chunks(size):
+			yield path, start, stop
+	finally:
+		mbox.close()
+
+def mbox_compression(path):
+	""" Return the compression of a file by its magic bytes, None if not compressed. """
+	with open(path, "rb") as handle:
+		head = handle.read(6)
+	for magic, compression in COMPRESSIONS:
+		if head.startswith(magic):
+			return compression
+	return None
+
+def stream_open(handle, compression):
+	""" Return a file object decompressing handle. """
+	if compression == "gzip":
+		return gzip.GzipFile(fileobj=handle, mode="rb")
+	if compression == "bz2" and bz2 is not None:
+		return bz2.BZ2File(handle, "rb")
+	if compression == "xz" and lzma is not None:
+		return lzma.LZMAFile(handle, "rb")
+	raise CompressionUnavailable(compression)
+
+def compress_open(path, mode, compression):
+	""" Return a file object compressing into path. """
+	if compression == "gzip":
+		return gzip.GzipFile(path, mode, GZIP_LEVEL)
+	if compression == "bz2" and bz2 is not None:
+		return bz2.BZ2File(path, mode)
+	if compression == "xz" and lzma is not None:
+		return lzma.LZMAFile(path, mode)
+	raise CompressionUnavailable(compression)
+
+def stream_blocks(path, compression, start=0):
+	""" Yield the decompressed blocks of a compressed file from byte offset start. """
+	with open(path, "rb") as handle:
+		handle.seek(start)
+		with stream_open(handle, compression) as stream:
+			while True:
+				block = stream.read(STREAM_BLOCK)
+				if not block:
+					return
+				yield block
+
+def gzip_blocks(path, jobs, size=DEFAULT_CHUNK_SIZE):
+	""" Yield the decompressed blocks of a gzip file, pieces of about size bytes are decompressed by worker processes.
+		Pieces start at the first gzip member found, the rest is streamed as soon as a piece does not follow its predecessor.
+		A file without a second member after the first piece is streamed right away. """
+	length = os.path.getsize(path)
+	expected = 0
+	pieces = length > size
+	if pieces:
+		with open(path, "rb") as handle:
+			pieces = gzip_member(handle, size, length) < length
+	if pieces:
+		pool = multiprocessing.Pool(jobs)
+		try:
+			pending = collections.deque()
+			starts = iter(range(0, length, size))
+			while True:
+				for start in starts:
+					pending.append(pool.apply_async(gzip_piece, (path, start, start + size, STREAM_RATIO * size)))
+					if len(pending) >= 2 * jobs:
+						break
+				if not pending:
+					break
+				begin, end, data = pending.popleft().get()
+				if data is None or begin != expected:
+					break
+				if data:
+					yield data
+				expected = end
+		finally:
+			pool.terminate()
+			pool.join()
+	if expected < length:
+		for block in stream_blocks(path, "gzip", expected):
+			yield block
+
+def gzip_piece(path, start, stop, limit):
+	""" Decompress the gzip members starting from the first one at or after start up to the first at or after stop.
+		Return the offsets of the first and the next member and the decompressed bytes, None if they exceed limit or are invalid. """
+	with open(path, "rb") as handle:
+		length = os.fstat(handle.fileno()).st_size
+		begin = gzip_member(handle, start, length)
+		pos = begin
+		data = []
+		total = 0
+		try:
+			while pos < min(stop, length):
+				handle.seek(pos)
+				member = zlib.decompressobj(31)
+				while not member.eof:
+					block = handle.read(STREAM_BLOCK)
+					if not block:
+						return begin, None, None
+					data.append(member.decompress(block))
+					total += len(data[-1])
+					if total > limit:
+						return begin, None, None
+				pos = handle.tell() - len(member.unused_data)
+		except zlib.error:
+			return begin, None, None
+	return begin, pos, b"".join(data)
+
+def gzip_member(handle, start, length):
+	""" Return the offset of the first gzip member at or after start, length if none.
+		A member is recognized by its magic bytes and a valid start of its compressed data. """
+	if start == 0:
+		return 0
+	pos = start
+	while pos < length:
+		handle.seek(pos)
+		block = handle.read(STREAM_BLOCK)
+		idx = block.find(GZIP_MAGIC)
+		if idx < 0:
+			# The magic bytes may span the blocks:
+			pos += max(1, len(block) - len(GZIP_MAGIC) + 1)
+			continue
+		handle.seek(pos + idx)
+		try:
+			zlib.decompressobj(31).decompress(handle.read(64 * 1024))
+			return pos + idx
+		except zlib.error:
+			pos += idx + 1
+	return length
+
+def checkpoint_fingerprint(path, offset):
+	""" Determine a MD5 value of the bytes at the start of a file and before offset. """
+	md5 = hashlib.md5()
+	with open(path, "rb") as handle:
+		md5.update(handle.read(min(offset, CHECKPOINT_FINGERPRINT)))
+		start = max(0, offset - CHECKPOINT_FINGERPRINT)
+		handle.seek(start)
+		md5.update(handle.read(offset - start))
+	return md5.hexdigest()
+
+def checkpoint_stop(path, start, stat):
+	""" Return the end of the complete mails of a mbox file after start. The last mail is complete, if the file
+		ends by a blank line or was not modified for CHECKPOINT_SETTLE seconds, else it ends before the last mail. """
+	size = stat.st_size
+	if size - start < 2 or time.time() - stat.st_mtime >= CHECKPOINT_SETTLE:
+		return size
+	with open(path, "rb") as handle:
+		handle.seek(size - 2)
+		if handle.read(2) == b"\n\n":
+			return size
+		# Search the last From line backwards, blocks overlap by the length of the pattern:
+		end = size
+		while True:
+			pos = max(start, end - CHECKPOINT_FINGERPRINT)
+			handle.seek(pos)
+			idx = handle.read(end - pos).rfind(b"\nFrom ")
+			if idx >= 0:
+				return pos + idx + 1
+			if pos == start:
+				return start
+			end = pos + 5
+
+def filter_combinable(pattern):
+	""" True if pattern may be joined with others into one alternation. """
+	return not re.search(r"\\[1-9]|\(\?P[<=]|\(\?[aiLmsux]+\)", pattern)
+
+def filter_compile(patterns, flags=0):
+	""" Compile patterns into one alternation. """
+	try:
+		if len(patterns) == 1:
+			return re.compile(patterns[0], flags)
+		return re.compile("|".join(["(?:%s)" %pattern for pattern in patterns]), flags)
+	except re.error:
+		raise RegularExpressionError("|".join(patterns))
+
+def payload_chunks(payload, size=DEFAULT_EXPORT_BUFFER):
+	""" Yield the decoded payload in chunks of about size characters of the encoded payload. """
+	cte = str(payload.get("content-transfer-encoding", "")).strip().lower()
+	encoded = payload.get_payload()
+	if payload.is_multipart() or not isinstance(encoded, str) or cte not in ("base64", "quoted-printable"):
+		yield payload.get_payload(decode=True) or b""
+		return
+	if cte == "base64":
+		parts = lambda: (payload_bytes(encoded[pos:pos + size]) for pos in range(0, len(encoded), size))
+		# One character beyond full groups can't be decoded, the payload is returned without line breaks then:
+		pending, pads, done = b"", 0, False
+		for part in parts():
+			decoded, pending, pads, done = base64_decode(part, pending, pads, False)
+			if done:
+				break
+		if len(pending) == 1:
+			for part in parts():
+				yield part.replace(b"\r", b"").replace(b"\n", b"")
+			return
+		pending, pads = b"", 0
+		for part in parts():
+			decoded, pending, pads, done = base64_decode(part, pending, pads)
+			yield decoded
+			if done:
+				return
+		if pending:
+			yield binascii.a2b_base64(pending + b"=" * (4 - len(pending)))
+		return
+	pos = 0
+	while pos < len(encoded):
+		# Decode whole lines only:
+		nxt = encoded.find("\n", pos + size) + 1 or len(encoded)
+		yield quopri.decodestring(payload_bytes(encoded[pos:nxt]))
+		pos = nxt
+
+def base64_decode(chunk, pending=b"", pads=0, decode=True):
+	""" Decode the base64 characters of chunk following pending ones, as binascii.a2b_base64 does: characters outside
+		the alphabet are skipped, a complete padding ends the data. Return the bytes decoded, the characters pending,
+		the number of pads in a row and whether the data ended. """
+	data = [pending]
+	size = len(pending)
+	for idx, part in enumerate(chunk.translate(None, BASE64_IGNORED).split(b"=")):
+		if idx:
+			pads += 1
+			# Pads after 2 or 3 characters of a group complete it:
+			if size % 4 >= 2 and size % 4 + pads >= 4:
+				data = b"".join(data)
+				return binascii.a2b_base64(data + b"=" * (4 - size % 4)) if decode else b"", b"", pads, True
+		if part:
+			data.append(part)
+			size += len(part)
+			pads = 0
+	data = b"".join(data)
+	cut = size - size % 4
+	return binascii.a2b_base64(data[:cut]) if decode else b"", data[cut:], pads, False
+
+def payload_text(payload, charset):
+	""" Decode the bytes of a text payload by its charset, by DEFAULT_ENCODING if missing or unknown. """
+	try:
+		return payload.decode(charset or DEFAULT_ENCODING, "replace")
+	except LookupError:
+		return payload.decode(DEFAULT_ENCODING, "replace")
+
+def spool_size(item):
+	""" Estimate the memory used by a mail or payload in bytes. """
+	if isinstance(item, (bytes, str)):
+		return len(item)
+	size = sum(len(key) + len(str(value)) for key, value in item.items())
+	payload = item.get_payload()
+	if isinstance(payload, list):
+		return size + sum(spool_size(part) for part in payload)
+	return size + spool_size(payload or "")
+
+def payload_index_format(index):
+	""" Format the path of indexes of a nested payload, e.g. (1, 2) as "01.02". """
+	return ".".join(["%02d" %idx for idx in index])
+
+def payload_bytes(strg):
+	""" Encode a part of an encoded payload as Message.get_payload does. """
+	try:
+		return strg.encode("ascii")
+	except UnicodeError:
+		try:
+			return strg.encode("ascii", "surrogateescape")
+		except UnicodeError:
+			return strg.encode("raw-unicode-escape")
+
+def index_addresses(rows):
+	""" Yield the rows of table Addresses for rows of table Mails. """
+	for row in rows:
+		for header, value in zip(INDEX_ADDRESS_FIELDS, row[2:6]):
+			for part in header_split(header, value or ""):
+				if part:
+					yield row[0], header, part, email.utils.parseaddr(part)[1].lower()
+
+def mail_md5_value(decode):
+	""" Determine the MD5 value of a mail from its headers decoded by decode(header). """
+	return md5_value(decode("Message-ID") + decode("Date") + decode("From") + decode("To"))
+
+def mail_digest(decode):
+	""" Determine the binary MD5 value of a mail from its headers decoded by decode(header). """
+	return hashlib.md5((decode("Message-ID") + decode("Date") + decode("From") + decode("To")).encode("UTF-8")).digest()
+
+def file_copy(src, dst, offset, length):
+	""" Copy length bytes at offset of file descriptor src to the position of dst in the kernel, return the number of bytes copied. """
+	copied = 0
+	for method in ("copy_file_range", "sendfile"):
+		if not hasattr(os, method):
+			continue
+		try:
+			while copied < length:
+				if method == "copy_file_range":
+					count = os.copy_file_range(src, dst, length - copied, offset + copied)
+				else:
+					count = os.sendfile(dst, src, offset + copied, length - copied)
+				if count == 0:
+					break
+				copied += count
+			return copied
+		except OSError:
+			continue
+	return copied
+
+def mail_decode(mail):
+	""" Return a function decoding the headers of mail. """
+	return lambda header: header_decode(mail[header])
+
 def md5_value(strg):
 	""" Returns the md5 value in hex-fromat of strg """
 	md5 = hashlib.md5()
 	md5.update(strg.encode('UTF-8'))
 	return md5.hexdigest()
 	
+# Decoded raw header values shared by all mails:
+header_decode_cache = HeaderCache()
+# Addresses of decoded header values shared by all mails:
+header_address_cache = HeaderCache()
+# Formatted keys by date value and format shared by all mails:
+date_format_cache = HeaderCache()
+# Timestamps by date value shared by all mails:
+date_timestamp_cache = HeaderCache()
+
 def header_decode(strg):
+	""" Decode header field, raw values are cached across mails. """
+	if type(strg) is str:
+		return header_decode_cache.get(strg, header_decode_field, strg)
+	return header_decode_field(strg)
+
+def header_decode_field(strg):
 	""" Decode header field. """
 	decoded = []
 	for field in email.header.decode_header(strg or ""):
@@ -440,24 +2925,94 @@ def header_values(header, mail):
 	""" Split header into a list """
 	if header not in mail.keys():
 		raise HeaderMissed(header)
-	values = [header_decode(mail[header])]
+	return list(header_split(header, header_decode(mail[header])))
+
+def header_split(header, value):
+	""" Split a decoded header value into a tuple, addresses are cached across mails. """
 	if header in HEADER_ADDRESS_FIELDS:
-		return [email.utils.formataddr(x) for x in email.utils.getaddresses(values)]
-	return values
+		return header_address_cache.get(value, header_addresses, value)
+	return (value,)
+
+def header_addresses(value):
+	""" Split a decoded header value into addresses. """
+	return tuple([email.utils.formataddr(x) for x in email.utils.getaddresses([value])])
 
 def header_format(header, value, form = DEFAULT_FORMAT):
 	""" Format header value by type. """
 	if header in HEADER_ADDRESS_FIELDS:
 		return header_email(value)
 	elif header == "Date":
-		parsed = email.utils.parsedate(value)
-		if parsed:
-			return time.strftime(form, parsed)
-		return ""
+		return date_format_cache.get((value, form), date_format, value, form)
 	if header == "Message-ID":
 		return email.utils.unquote(value)
 	return value[:DEFAULT_MAXLEN]
 
+def index_date_years(patterns):
+	""" Return the UTC ranges of the years named by literal Date patterns, None unless every pattern names one. """
+	ranges = []
+	for pattern in patterns:
+		match = INDEX_DATE_YEAR.fullmatch(pattern)
+		if match is None:
+			return None
+		year = int(match.group(1))
+		if not 0 < year < 9999:
+			return None
+		ranges.append((datetime.datetime(year, 1, 1, tzinfo=datetime.timezone.utc).timestamp(), datetime.datetime(year + 1, 1, 1, tzinfo=datetime.timezone.utc).timestamp()))
+	return ranges
+
+def header_timestamp(value):
+	""" Convert a date value into seconds since the epoch (UTC), None if invalid. Cached across mails. """
+	return date_timestamp_cache.get(value, date_timestamp_tz, value)
+
+def date_parse_tz(value):
+	""" Parse a date value like email.utils.parsedate_tz, common layouts without it. """
+	match = DATE_PATTERN.match(value)
+	if match:
+		day, month, year, hour, minute, second, zone = match.groups()
+		month = DATE_MONTHS.get(month.lower())
+		# "-0000" is treated differently by Python versions:
+		if month and zone != "-0000":
+			offset = int(zone[1:3]) * 3600 + int(zone[3:5]) * 60
+			return (int(year), month, int(day), int(hour), int(minute), int(second or 0), 0, 1, -1, -offset if zone[0] == "-" else offset)
+	return email.utils.parsedate_tz(value)
+
+def date_format(value, form):
+	""" Format a date value by form, "" if invalid. """
+	parsed = date_parse_tz(value)
+	if parsed:
+		return time.strftime(form, parsed[:9])
+	return ""
+
+def date_timestamp_tz(value):
+	""" Convert a date value into seconds since the epoch (UTC), None if invalid. """
+	parsed = date_parse_tz(value)
+	if parsed is None:
+		return None
+	try:
+		return email.utils.mktime_tz(parsed)
+	except (OverflowError, ValueError):
+		return None
+
+def date_timestamp(value):
+	""" Convert seconds, a datetime (naive as UTC), an ISO 8601 or RFC 2822 date into seconds since the epoch. """
+	if value is None or isinstance(value, (int, float)):
+		return value
+	if isinstance(value, str):
+		timestamp = date_timestamp_tz(value)
+		if timestamp is not None:
+			return timestamp
+		try:
+			value = datetime.datetime.fromisoformat(value.strip())
+		except ValueError:
+			raise DateInvalid(value)
+	if isinstance(value, datetime.datetime):
+		if value.tzinfo is None:
+			value = value.replace(tzinfo=datetime.timezone.utc)
+		return value.timestamp()
+	if isinstance(value, datetime.date):
+		return datetime.datetime(value.year, value.month, value.day, tzinfo=datetime.timezone.utc).timestamp()
+	raise DateInvalid(value)
+
 def python_decode(strg, enc):
 	""" Decode strings for python < 3. """
 	if type(strg) is bytes:
@@ -470,6 +3025,14 @@ def cli_protocol(val):
 		return (m.group(1), m.group(2) or "")
 	raise CLIProtocollError()
 
+def cli_stats(statistics):
+	""" Write times per stage and throughput to STDERR. """
+	for name, stage in statistics["stages"].items():
+		if stage["calls"]:
+			sys.stderr.write("%-20s %10s calls %10.3fs wall %10.3fs cpu\n" %(name, stage["calls"], stage["wall"], stage["cpu"]))
+	sys.stderr.write("%(bytes_read)s bytes read, %(bytes_written)s bytes written, %(bytes_exported)s bytes exported, %(mails_per_s).1f mails/s, %(mb_per_s).2f MB/s\n" %statistics)
+	sys.stderr.write("%(hits)s header hits, %(misses)s header misses, " %statistics["cache"]["decode"] + "%(spilled)s cached items spilled\n" %statistics["cache"]["spool"])
+
 def cli_info():
 	sys.stderr.write("mboxfilter v"+__version__+"\n")
 
@@ -479,13 +3042,20 @@ def cli_usage():
 	[--filter_from regexp] [--filter_to regexp] [--filter_date regexp]
 	[--filter header,regexp] [--sort_from] [--sort_to] [--sort_date format]
 	[--sort header,regexp] [--failures path] [--quiet]
-	[--export] [--exportpath path] [--reduce]
+	[--export] [--exportpath path] [--reduce] [--filter_or_logic]
+	[--max_open n] [--index_batch n] [--ignorecase] [--fixed_strings]
+	[--scan_headers] [--reader mailbox|mmap] [--jobs n] [--resume]
+	[--export_store] [--query] [--fulltext] [--search query]
+	[--stats] [--stats_json path] [--progress seconds]
+	[--since date] [--until date] [--max_keys n] [--serialize]
+	[--writers n] [--compress gzip|bz2|xz] [--dedup set|bloom|none]
+	[--dedup_capacity n]
 	mbox ...\n""")
 	
 def cli():
 	""" Invoke mboxfilter from cmd."""
 	try:
-		opts, args = getopt.getopt(sys.argv[1:], None, ["dir=", "unique", "archive", "sort_from", "filter_from=", "sort_date=", "filter_date=", "filter_to=", "sort_to", "filter=", "sort=", "help", "quiet", "version", "failures=", "export", "exportpath=", "reduce"])
+		opts, args = getopt.getopt(sys.argv[1:], None, ["dir=", "unique", "archive", "sort_from", "filter_from=", "sort_date=", "filter_date=", "filter_to=", "sort_to", "filter=", "sort=", "help", "quiet", "version", "failures=", "export", "exportpath=", "reduce", "filter_or_logic", "max_open=", "index_batch=", "ignorecase", "fixed_strings", "scan_headers", "reader=", "jobs=", "resume", "export_store", "query", "fulltext", "search=", "stats", "stats_json=", "progress=", "since=", "until=", "max_keys=", "serialize", "writers=", "compress=", "dedup=", "dedup_capacity="])
 		output = DEFAULT_OUTPUT
 		selectors = []
 		archive = DEFAULT_ARCHIVE
@@ -496,6 +3066,30 @@ def cli():
 		export = DEFAULT_EXPORT
 		exportpath = None
 		reduce = DEFAULT_REDUCE
+		filter_or_logic = DEFAULT_FILTER_OR_LOGIC
+		max_open = DEFAULT_MAX_OPEN
+		index_batch = DEFAULT_INDEX_BATCH
+		ignorecase = DEFAULT_IGNORECASE
+		fixed_strings = DEFAULT_FIXED_STRINGS
+		scan_headers = DEFAULT_SCAN_HEADERS
+		reader = DEFAULT_READER
+		jobs = DEFAULT_JOBS
+		resume = DEFAULT_RESUME
+		export_store = DEFAULT_EXPORT_STORE
+		query = False
+		fulltext = DEFAULT_FULLTEXT
+		search = None
+		stats = DEFAULT_STATS
+		stats_json = None
+		progress = DEFAULT_PROGRESS
+		since = None
+		until = None
+		max_keys = DEFAULT_MAX_KEYS
+		passthrough = DEFAULT_PASSTHROUGH
+		writers = DEFAULT_WRITERS
+		compression = DEFAULT_COMPRESSION
+		dedup = DEFAULT_DEDUP
+		dedup_capacity = DEFAULT_DEDUP_CAPACITY
 		for opt, val in opts:
 			val = python_decode(val, sys.stdin.encoding)
 			if opt == "--dir":
@@ -538,16 +3132,71 @@ def cli():
 				exportpath = val
 			elif opt == "--reduce":
 				reduce = True
-		filt = Filter(output=output, archive=archive, indexing=unique, filters=filters, filter_or_logic=filter_or_logic, selectors=selectors, failures=failures, export_payload=export, payload_exportpath=exportpath, reduce_payload=reduce, quiet=quiet)
-		for mbox in args:
-			filt.filter_mbox(mbox)
+			elif opt == "--max_open":
+				max_open = int(val)
+			elif opt == "--index_batch":
+				index_batch = int(val)
+			elif opt == "--ignorecase":
+				ignorecase = True
+			elif opt == "--fixed_strings":
+				fixed_strings = True
+			elif opt == "--scan_headers":
+				scan_headers = True
+			elif opt == "--reader":
+				reader = val
+			elif opt == "--jobs":
+				jobs = int(val)
+			elif opt == "--resume":
+				resume = True
+			elif opt == "--export_store":
+				export_store = True
+			elif opt == "--query":
+				query = True
+			elif opt == "--fulltext":
+				fulltext = True
+			elif opt == "--search":
+				search = val
+			elif opt == "--stats":
+				stats = True
+			elif opt == "--stats_json":
+				stats_json = val
+			elif opt == "--progress":
+				progress = float(val)
+			elif opt == "--since":
+				since = val
+			elif opt == "--until":
+				until = val
+			elif opt == "--max_keys":
+				max_keys = int(val)
+			elif opt == "--serialize":
+				passthrough = False
+			elif opt == "--writers":
+				writers = int(val)
+			elif opt == "--compress":
+				compression = val
+			elif opt == "--dedup":
+				dedup = False if val == "none" else val
+			elif opt == "--dedup_capacity":
+				dedup_capacity = int(val)
+		filt = Filter(output=output, archive=archive, indexing=unique, filters=filters, filter_or_logic=filter_or_logic, selectors=selectors, failures=failures, export_payload=export, payload_exportpath=exportpath, reduce_payload=reduce, quiet=quiet, max_open=max_open, index_batch=index_batch, ignorecase=ignorecase, fixed_strings=fixed_strings, scan_headers=scan_headers, reader=reader, jobs=jobs, resume=resume, export_store=export_store, fulltext=fulltext, stats=stats or stats_json is not None, progress=progress, since=since, until=until, max_keys=max_keys, passthrough=passthrough, writers=writers, compression=compression, dedup=dedup, dedup_capacity=dedup_capacity)
+		if query or search is not None:
+			filt.filter_index(args or None, search)
+		else:
+			filt.filter_many(args)
 		if not quiet:
-			sys.stderr.write("%s filtered, %s passed, %s failed, %s exported, %s deleted\n" %(str(filt.filtered), str(filt.passed), str(filt.failed), str(filt.exported), str(filt.deleted)))
+			sys.stderr.write("%s filtered, %s passed, %s failed, %s exported, %s stored, %s deleted of %s payloads\n" %(str(filt.filtered), str(filt.passed), str(filt.failed), str(filt.exported), str(filt.stored), str(filt.deleted), str(filt.visited)))
+			sys.stderr.write("%(hits)s handle hits, %(misses)s handle misses, %(evictions)s evictions\n" %filt.output_pool.statistics())
+		if stats:
+			cli_stats(filt.statistics())
+		if stats_json:
+			with open(stats_json, "w") as handle:
+				json.dump(filt.statistics(), handle, indent=2)
+				handle.write("\n")
 	except getopt.GetoptError as excp:
 		sys.stderr.write(str(excp)+"\n\n")
 		cli_usage()
 		sys.exit(1)
-	except DirectoryNotExisting as excp:
+	except (DirectoryNotExisting, RegularExpressionError, ReaderUnknown, HeaderNotIndexed, FulltextUnavailable, DateInvalid, DedupUnknown, CompressionUnavailable) as excp:
 		sys.stderr.write(str(excp))
 		sys.exit(1)
 	except SystemExit:
@@ -0,0 +1,212 @@
+"""
+Measure the throughput of mboxfilter on reproducible synthetic mboxes
+"""
+import email.header
+import email.mime.application
+import email.mime.multipart
+import email.mime.text
+import email.utils
+import getopt
+import json
+import mailbox
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import mboxfilter
+
+# Number of mails (default):
+DEFAULT_COUNT = 1000
+# Size of an attachment in bytes (default):
+DEFAULT_ATTACHMENT_SIZE = 64 * 1024
+# Share of mails with attachments (default):
+DEFAULT_ATTACHMENTS = 0.2
+# Share of mails with encoded header values (default):
+DEFAULT_ENCODED = 0.5
+# Maximum number of receivers per mail (default):
+DEFAULT_RECIPIENTS = 5
+# Number of distinct senders and receivers (default):
+DEFAULT_USERS = 50
+# Seed of the generator (default):
+DEFAULT_SEED = 1
+
+# Names of users, some need encoding:
+NAMES = ["Frank W\xf6ller", "Anna Mei\xdfner", "Jos\xe9 Garc\xeda", "Peter Smith", "Rosie Jones", "J\xfcrgen M\xfcller"]
+# Charsets of encoded header values:
+CHARSETS = ["iso-8859-1", "utf-8"]
+
+# Filter settings of the scenarios:
+SCENARIOS = {
+	"filter": {"filters": [("From", "user1[0-9]@")]},
+	"sort": {"selectors": [("From", None), ("To", None)]},
+	"archive": {"archive": True, "selectors": [("Date", "%Y")]},
+	"export": {"export_payload": True, "reduce_payload": True},
+	"caching": {"caching": True},
+}
+
+def generate_mbox(path, count=DEFAULT_COUNT, attachment_size=DEFAULT_ATTACHMENT_SIZE, attachments=DEFAULT_ATTACHMENTS, encoded=DEFAULT_ENCODED, recipients=DEFAULT_RECIPIENTS, users=DEFAULT_USERS, seed=DEFAULT_SEED):
+	""" Write a mbox of count synthetic mails to path, the same for the same arguments. """
+	rand = random.Random(seed)
+	mbox = mailbox.mbox(path, create=True)
+	mbox.lock()
+	try:
+		for idx in range(count):
+			mbox.add(generate_mail(rand, idx, attachment_size, attachments, encoded, recipients, users))
+		mbox.flush()
+	finally:
+		mbox.unlock()
+		mbox.close()
+	return path
+
+def generate_mail(rand, idx, attachment_size, attachments, encoded, recipients, users):
+	""" Create a synthetic mail. """
+	body = " ".join(rand.choice(["lorem", "ipsum", "dolor", "sit", "amet", "From", "consetetur"]) for i in range(rand.randint(20, 200)))
+	if rand.random() < attachments:
+		mail = email.mime.multipart.MIMEMultipart(boundary="==bench-%s==" %idx)
+		mail.attach(email.mime.text.MIMEText(body))
+		part = email.mime.application.MIMEApplication(rand.getrandbits(8 * attachment_size).to_bytes(attachment_size, "little"), "octet-stream")
+		part.add_header("Content-Disposition", "attachment", filename="file%s.bin" %idx)
+		mail.attach(part)
+	else:
+		mail = email.mime.text.MIMEText(body)
+	enc = rand.random() < encoded
+	mail["From"] = generate_address(rand, rand.randrange(users), enc)
+	mail["To"] = ", ".join([generate_address(rand, rand.randrange(users), enc) for i in range(rand.randint(1, max(1, recipients)))])
+	mail["Subject"] = generate_header(rand, "Mail %s %s" %(idx, rand.choice(NAMES)), enc)
+	date = 1262304000 + rand.randrange(0, 10 * 365 * 86400)
+	mail["Date"] = email.utils.formatdate(date, localtime=False)
+	mail.set_unixfrom("From bench@mboxfilter " + time.asctime(time.gmtime(date)))
+	mail["Message-ID"] = "<bench-%s-%s@mboxfilter>" %(idx, rand.getrandbits(32))
+	return mail
+
+def generate_address(rand, user, enc):
+	""" Create the address of a user. """
+	name = NAMES[user % len(NAMES)]
+	if enc:
+		return email.utils.formataddr((email.header.Header(name, rand.choice(CHARSETS)).encode(), "user%s@example.org" %user))
+	return email.utils.formataddr((name.encode("ascii", "replace").decode("ascii"), "user%s@example.org" %user))
+
+def generate_header(rand, value, enc):
+	""" Create a header value, encoded or not. """
+	if enc:
+		return email.header.Header(value, rand.choice(CHARSETS))
+	return value.encode("ascii", "replace").decode("ascii")
+
+def run_scenario(name, path, workdir, options={}):
+	""" Filter path by a scenario in a fresh process, return its measurements. """
+	pool = multiprocessing.Pool(1)
+	try:
+		return pool.apply(measure_scenario, (name, path, workdir, options))
+	finally:
+		pool.terminate()
+		pool.join()
+
+def measure_scenario(name, path, workdir, options={}):
+	""" Filter path by a scenario, return its measurements. """
+	output = os.path.join(workdir, name)
+	shutil.rmtree(output, True)
+	os.mkdir(output)
+	settings = dict(SCENARIOS[name])
+	settings.update(options)
+	stdout = sys.stdout
+	# Results without selectors go to STDOUT:
+	sys.stdout = open(os.devnull, "w")
+	try:
+		start, cpu = time.time(), time.process_time()
+		filt = mboxfilter.Filter(output=output, payload_exportpath=output, quiet=True, **settings)
+		filt.filter_mbox(path)
+		seconds, cpu = time.time() - start, time.process_time() - cpu
+	finally:
+		sys.stdout.close()
+		sys.stdout = stdout
+	size = os.path.getsize(path)
+	return {
+		"scenario": name,
+		"mails": filt.filtered,
+		"passed": filt.passed,
+		"failed": filt.failed,
+		"seconds": round(seconds, 4),
+		"cpu_seconds": round(cpu, 4),
+		"msgs_per_s": round(filt.filtered / seconds, 1) if seconds else None,
+		"mb_per_s": round(size / 1048576.0 / seconds, 3) if seconds else None,
+		# Kilobytes on Linux:
+		"peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+	}
+
+def benchmark(scenarios=None, workdir=None, options={}, **generator):
+	""" Generate a mbox and run the scenarios on it, return the results. """
+	scenarios = scenarios or sorted(SCENARIOS.keys())
+	settings = {"count": DEFAULT_COUNT, "attachment_size": DEFAULT_ATTACHMENT_SIZE, "attachments": DEFAULT_ATTACHMENTS, "encoded": DEFAULT_ENCODED, "recipients": DEFAULT_RECIPIENTS, "users": DEFAULT_USERS, "seed": DEFAULT_SEED}
+	settings.update(generator)
+	tmpdir = workdir or tempfile.mkdtemp(prefix="mboxfilter-bench-")
+	try:
+		path = generate_mbox(os.path.join(tmpdir, "bench.mbox"), **settings)
+		return {
+			"version": mboxfilter.__version__,
+			"python": sys.version.split()[0],
+			"mbox_bytes": os.path.getsize(path),
+			"generator": settings,
+			"options": options,
+			"results": [run_scenario(name, path, tmpdir, options) for name in scenarios],
+		}
+	finally:
+		if workdir is None:
+			shutil.rmtree(tmpdir, True)
+
+def cli_usage():
+	sys.stderr.write("""Usage:
+	mboxfilter_bench [--help] [--count n] [--attachment_size bytes]
+	[--attachments ratio] [--encoded ratio] [--recipients n] [--users n]
+	[--seed n] [--scenario name] [--dir path] [--output path]
+	[--reader mailbox|mmap] [--scan_headers] [--jobs n]
+	scenarios: %s\n""" %", ".join(sorted(SCENARIOS.keys())))
+
+def cli():
+	""" Invoke the benchmark from cmd, write results as JSON. """
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], None, ["help", "count=", "attachment_size=", "attachments=", "encoded=", "recipients=", "users=", "seed=", "scenario=", "dir=", "output=", "reader=", "scan_headers", "jobs="])
+		generator = {}
+		options = {}
+		scenarios = []
+		workdir = None
+		output = None
+		for opt, val in opts:
+			if opt == "--help":
+				cli_usage()
+				sys.exit(0)
+			elif opt in ("--count", "--attachment_size", "--recipients", "--users", "--seed"):
+				generator[opt[2:]] = int(val)
+			elif opt in ("--attachments", "--encoded"):
+				generator[opt[2:]] = float(val)
+			elif opt == "--scenario":
+				if val not in SCENARIOS:
+					raise getopt.GetoptError("scenario unknown: %s" %val)
+				scenarios.append(val)
+			elif opt == "--dir":
+				workdir = val
+			elif opt == "--output":
+				output = val
+			elif opt == "--reader":
+				options["reader"] = val
+			elif opt == "--scan_headers":
+				options["scan_headers"] = True
+			elif opt == "--jobs":
+				options["jobs"] = int(val)
+		results = json.dumps(benchmark(scenarios, workdir, options, **generator), indent=2)
+		if output:
+			with open(output, "w") as handle:
+				handle.write(results + "\n")
+		else:
+			sys.stdout.write(results + "\n")
+	except getopt.GetoptError as excp:
+		sys.stderr.write(str(excp)+"\n\n")
+		cli_usage()
+		sys.exit(1)
+
+if __name__ == "__main__":
+	cli()
@@ -1,4 +1,4 @@
-from distutils.core import setup
+from setuptools import setup
 import mboxfilter
 
 setup(
@@ -10,12 +10,12 @@ setup(
     license = 'MIT',
     description = 'Filter and sort mails from mboxes for archiving and reporting.',
     long_description = open('README.rst', 'r').read(),
-    py_modules = ['mboxfilter'],
-    scripts = ['bin/mboxfilter'],
+    py_modules = ['mboxfilter', 'mboxfilter_bench'],
+    scripts = ['bin/mboxfilter', 'bin/mboxfilter_bench'],
+    python_requires = '>=3.6',
     classifiers = [
-     "Programming Language :: Python :: 2",
-     "Programming Language :: Python :: 2.6",
-     "Programming Language :: Python :: 2.7",
+     "Programming Language :: Python :: 3",
+     "Programming Language :: Python :: 3 :: Only",
      "License :: OSI Approved :: MIT License",
      "Topic :: Communications :: Email"
     ]
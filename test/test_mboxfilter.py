@@ -5,7 +5,14 @@ import email.mime.text
 import email.mime.image
 import email.mime.multipart
 import email.header
+import email.utils
+import binascii
+import bz2
+import datetime
+import gzip
 import io
+import json
+import lzma
 import mailbox
 import mboxfilter
 import os
@@ -186,6 +193,629 @@ class TestMboxFilter(unittest.TestCase):
 		self.assertEqual(str(m[0]), str(fil_1.passed_mails[0]))
 		self.assertEqual(str(m[0]), str(fil_1.resultset[None][0]))
 
+	def test_output_pool(self):
+		pool = mboxfilter.OutputPool(max_open=2)
+		for name in ["a", "b", "a", "c", "b"]:
+			pool.handle(DIR + "/pool." + name).write(name.encode())
+		self.assertEqual(2, len(pool.handles))
+		pool.close()
+		self.assertEqual({"hits": 1, "misses": 4, "evictions": 2, "open": 0, "max_open": 2}, pool.statistics())
+		self.assertEqual(b"aa", file_read(DIR + "/pool.a"))
+		self.assertEqual(b"bb", file_read(DIR + "/pool.b"))
+
+	def test_output_pool_filter(self):
+		output = output_dir("pool")
+		fil = mboxfilter.Filter(output=output, selectors=[("Date", "%Y")], max_open=1, quiet=True)
+		fil.filter_mbox(MBOX_1)
+		self.assertEqual(0, len(fil.output_pool.handles))
+		self.assertEqual(1, fil.output_pool.misses)
+		self.assertEqual(6, len(mailbox.mbox(output + "/2013.mbox")))
+
+	def test_index_batch(self):
+		fil = mboxfilter.Filter(output=output_dir("index_batch"), archive=True, selectors=[("Date", "%Y")], index_batch=100, index_interval=3600, quiet=True)
+		fil.filter_mail(mailbox.mbox(MBOX_1)[0])
+		self.assertEqual(1, len(fil.index_rows))
+		self.assertEqual(0, fil.db.execute("SELECT COUNT(*) FROM Mails").fetchone()[0])
+		fil.filter_mbox(MBOX_1)
+		self.assertEqual(0, len(fil.index_rows))
+		self.assertEqual(6, fil.db.execute("SELECT COUNT(*) FROM Mails").fetchone()[0])
+		self.assertEqual(3, fil.failed)
+		fil.filter_mbox(MBOX_1)
+		self.assertEqual(6, fil.db.execute("SELECT COUNT(*) FROM Mails").fetchone()[0])
+		self.assertEqual(10, fil.failed)
+		# Mails indexed by another filter meanwhile are rejected at commit, once:
+		for writers in [0, 2]:
+			output = output_dir("index_batch_%s" % writers)
+			fil = mboxfilter.Filter(output=output, archive=True, selectors=[("Date", "%Y")], index_batch=100, index_interval=3600, writers=writers, quiet=True)
+			other = mboxfilter.Filter(output=output, archive=True, selectors=[("Date", "%Y")], quiet=True)
+			other.filter_mbox(MBOX_1)
+			fil.filter_mbox(MBOX_1)
+			self.assertEqual((7, 0, 7), (fil.filtered, fil.passed, fil.failed))
+
+	def test_filter_plan(self):
+		plan = mboxfilter.FilterPlan([("From", "a"), ("From", "b"), ("To", "c", "f"), ("From", r"(x)\1")], or_logic=True)
+		self.assertEqual([["a", "b"], ["c"], [r"(x)\1"]], [matcher.patterns for matcher in plan])
+		self.assertEqual(4, len(mboxfilter.FilterPlan([("From", "a"), ("From", "b"), ("To", "c"), ("To", "d")])))
+		self.assertRaises(mboxfilter.RegularExpressionError, mboxfilter.Filter, filters=[("From", "(")])
+		matcher = mboxfilter.FilterMatcher("From", ["Woe.ler"], fixed=True)
+		self.assertFalse(matcher.search(MAIL_1))
+		matcher = mboxfilter.FilterMatcher("From", ["WOELLER"], ignorecase=True, fixed=True)
+		self.assertTrue(matcher.search(MAIL_1))
+		# A single filter applied by the former method:
+		fil = mboxfilter.Filter(ignorecase=True, quiet=True)
+		fil.filter_matches = {}
+		self.assertTrue(fil.filter_item_pass("From", "WOELLER", MAIL_1))
+		self.assertFalse(fil.filter_item_pass("From", "peter@", MAIL_1))
+		self.assertEqual({"From": [MAIL_1]}, fil.filter_matches)
+		self.assertRaises(mboxfilter.RegularExpressionError, fil.filter_item_pass, "From", "(", MAIL_1)
+
+	def test_filter_fixed_ignorecase(self):
+		fil = mboxfilter.Filter(caching=True, filters=[("From", MAIL_1.upper(), "if")], quiet=True)
+		fil.filter_mbox(MBOX_1)
+		self.assertEqual(2, fil.passed)
+		fil = mboxfilter.Filter(caching=True, filters=[("From", MAIL_1.upper()), ("To", MAIL_1)], filter_or_logic=True, fixed_strings=True, quiet=True)
+		fil.filter_mbox(MBOX_1)
+		self.assertEqual(4, fil.passed)
+
+	def test_scan_headers(self):
+		m = mailbox.mbox(MBOX_1)
+		entry = mboxfilter.MboxEntry(m, m.keys()[0])
+		self.assertEqual(m[0]["Message-ID"], entry.headers()["Message-ID"])
+		self.assertFalse(entry.headers().get_payload())
+		fil = mboxfilter.Filter(caching=True, filters=[("From", MAIL_1)], scan_headers=True, quiet=True)
+		fil.filter_mbox(MBOX_1)
+		self.assertEqual(7, fil.filtered)
+		self.assertEqual(1, fil.failed)
+		self.assertEqual([str(m[0]), str(m[1])], [str(mail) for mail in fil.passed_mails])
+		# A mail failing to parse is not parsed again for the failure log:
+		def broken():
+			raise ValueError("broken")
+		entry.message = broken
+		stderr = sys.stderr
+		sys.stderr = io.StringIO()
+		try:
+			for quiet in [True, False]:
+				fil = mboxfilter.Filter(caching=True, quiet=quiet)
+				self.assertEqual(None, fil.filter_entry(entry))
+				self.assertEqual(1, fil.failed)
+				self.assertEqual([], list(fil.failed_mails))
+			self.assertEqual("error: broken\n", sys.stderr.getvalue())
+		finally:
+			sys.stderr = stderr
+
+	def test_mmap_reader(self):
+		m = mailbox.mbox(MBOX_1)
+		mbox = mboxfilter.MmapMbox(MBOX_1)
+		entries = list(mbox)
+		self.assertEqual(len(m), len(entries))
+		self.assertEqual(os.path.getsize(MBOX_1), sum([entry.length for entry in entries]))
+		for i, entry in enumerate(entries):
+			self.assertEqual(m.get_bytes(m.keys()[i], True), entry.raw()[:len(m.get_bytes(m.keys()[i], True))])
+			self.assertEqual(str(m[i]), str(entry.message()))
+			self.assertEqual(m[i].get_from(), entry.message().get_from())
+			self.assertEqual(m[i].items(), entry.headers().items())
+		mbox.close()
+		fil = mboxfilter.Filter(caching=True, filters=[("From", MAIL_1)], reader="mmap", scan_headers=True, quiet=True)
+		fil.filter_mbox(MBOX_1)
+		self.assertEqual([str(m[0]), str(m[1])], [str(mail) for mail in fil.passed_mails])
+		self.assertRaises(mboxfilter.ReaderUnknown, mboxfilter.Filter, reader="maildir")
+
+	def test_parallel(self):
+		results = []
+		for jobs in [1, 3]:
+			output = output_dir("jobs_%s" % jobs)
+			fil = mboxfilter.Filter(output=output, archive=True, selectors=[("From", None), ("To", None)], jobs=jobs, chunk_size=1, export_payload=True, reduce_payload=True, payload_exportpath=output, failures=output + "/failures", quiet=True)
+			fil.filter_mbox(MBOX_1)
+			files = sorted([name for name in os.listdir(output) if not name.startswith("index.")])
+			results.append(((fil.filtered, fil.passed, fil.failed, fil.exported, fil.deleted), files, [file_read(output + "/" + name) for name in files]))
+		self.assertEqual((7, 5, 2, 4, 4), results[0][0])
+		self.assertEqual(results[0], results[1])
+		# Workers export by themselves, also when the parent writes by threads:
+		results = []
+		for jobs, writers in [(1, 0), (3, 2)]:
+			output = output_dir("jobs_writers_%s" % jobs)
+			fil = mboxfilter.Filter(output=output, selectors=[("Date", "%Y")], jobs=jobs, chunk_size=1, writers=writers, export_payload=True, export_store=True, payload_exportpath=output, quiet=True)
+			fil.filter_mbox(MBOX_1)
+			fil.filter_mbox(MBOX_1)
+			rows = fil.db.execute('SELECT "Message-ID", "Index", "SHA256-Value" FROM Attachments ORDER BY "Message-ID", "Index"').fetchall()
+			results.append(((fil.filtered, fil.passed, fil.failed, fil.exported), rows, [file_read(fil.output_attachment_path(row[2])) for row in rows]))
+		self.assertEqual(4, len(results[0][1]))
+		self.assertEqual(results[0], results[1])
+
+	def test_parallel_many(self):
+		results = []
+		for jobs in [1, 2]:
+			output = output_dir("many_%s" % jobs)
+			fil = mboxfilter.Filter(output=output, archive=True, selectors=[("Date", "%Y")], jobs=jobs, quiet=True)
+			fil.filter_many([MBOX_1, MBOX_1])
+			results.append(((fil.filtered, fil.passed, fil.failed), file_read(output + "/2013.mbox"), fil.db.execute("SELECT COUNT(*) FROM Mails").fetchone()[0]))
+		self.assertEqual((14, 5, 9), results[0][0])
+		self.assertEqual(results[0], results[1])
+		# Results follow the order of the files, compressed ones too:
+		mbox = mboxfilter.MmapMbox(MBOX_1)
+		with open(DIR + "/reversed.gz", "wb") as handle:
+			handle.write(gzip.compress(b"".join(entry.raw() for entry in reversed(list(mbox)))))
+		mbox.close()
+		results = []
+		for jobs in [1, 2]:
+			output = output_dir("many_order_%s" % jobs)
+			fil = mboxfilter.Filter(output=output, selectors=[("Date", "%Y")], jobs=jobs, quiet=True)
+			fil.filter_many([MBOX_1, DIR + "/reversed.gz", MBOX_1])
+			results.append(file_read(output + "/2013.mbox"))
+		self.assertEqual(results[0], results[1])
+
+	def test_resume(self):
+		output = output_dir("resume")
+		path = output + "/mbox"
+		shutil.copy(MBOX_1, path)
+		fil = mboxfilter.Filter(output=output, selectors=[("Date", "%Y")], resume=True, quiet=True)
+		fil.filter_mbox(path)
+		self.assertEqual((7, 6), (fil.filtered, fil.passed))
+		fil.filter_mbox(path)
+		self.assertEqual((7, 6), (fil.filtered, fil.passed))
+		m = mailbox.mbox(path)
+		m.add(m[0])
+		m.close()
+		fil = mboxfilter.Filter(output=output, selectors=[("Date", "%Y")], resume=True, quiet=True)
+		fil.filter_mbox(path)
+		self.assertEqual((1, 1), (fil.filtered, fil.passed))
+		fil = mboxfilter.Filter(output=output, selectors=[("Date", "%m")], resume=True, quiet=True)
+		fil.filter_mbox(path)
+		self.assertEqual((8, 7), (fil.filtered, fil.passed))
+		with open(path, "r+b") as handle:
+			handle.write(b"From X")
+		fil = mboxfilter.Filter(output=output, selectors=[("Date", "%Y")], resume=True, quiet=True)
+		fil.filter_mbox(path)
+		self.assertEqual((8, 7), (fil.filtered, fil.passed))
+		self.assertEqual(14, len(mailbox.mbox(output + "/2013.mbox")))
+		# A mail being appended is left for the next run:
+		mail = b"From a@b.c Fri Jun 21 12:15:00 2013\nFrom: a@b.c\nTo: d@e.f\nDate: " + DATE_1.encode() + b"\nMessage-ID: <appended>\n\nbody\n\n"
+		for part, filtered in [(mail[:60], 0), (mail[60:], 1)]:
+			with open(path, "ab") as handle:
+				handle.write(part)
+			fil = mboxfilter.Filter(output=output, selectors=[("Date", "%Y")], resume=True, quiet=True)
+			fil.filter_mbox(path)
+			self.assertEqual((filtered, filtered), (fil.filtered, fil.passed))
+
+	def test_header_cache(self):
+		cache = mboxfilter.HeaderCache(2)
+		for key in ["a", "b", "a", "c", "b"]:
+			self.assertEqual(key.upper(), cache.get(key, str.upper, key))
+		self.assertEqual({"hits": 1, "misses": 4, "size": 2, "maxsize": 2}, cache.statistics())
+		mboxfilter.header_decode_cache.clear()
+		fil = mboxfilter.Filter(output=output_dir("header_cache"), indexing=True, filters=[("From", MAIL_4)], selectors=[("From", None)], caching=True, quiet=True)
+		fil.filter_mbox(MBOX_1)
+		self.assertEqual(1, fil.passed)
+		statistics = fil.cache_statistics()
+		self.assertTrue(statistics["view"]["hits"] >= 4)
+		self.assertTrue(statistics["decode"]["hits"] >= 4)
+		view = fil.mail_view(mailbox.mbox(MBOX_1)[0])
+		self.assertEqual(mboxfilter.header_values("To", view.mail), list(view.values("To")))
+		self.assertRaises(mboxfilter.HeaderMissed, view.values, "Subject")
+
+	def test_payload_stream(self):
+		output = output_dir("payload_stream")
+		fil = mboxfilter.Filter(output=output, filters=[("From", MAIL_1), ("To", MAIL_2)], selectors=[("Date", "%Y")], export_payload=True, payload_exportpath=output, export_buffer=5, export_fsync=3, quiet=True)
+		fil.filter_mbox(MBOX_1)
+		self.assertEqual(4, fil.exported)
+		self.assertEqual([], fil.export_unsynced)
+		self.assertEqual(file_read("test.txt"), file_read(output + "/mssgid-1.01.test.txt"))
+		self.assertEqual(file_read("test.png"), file_read(output + "/mssgid-1.02.test.png"))
+		self.assertEqual(file_read("test.odt"), file_read(output + "/mssgid-1.03.test.odt"))
+		self.assertEqual(file_read("test.pdf"), file_read(output + "/mssgid-1.04.test.pdf"))
+		payload = email.message_from_string("Content-Transfer-Encoding: quoted-printable\n\nL=C3=B6rem=\n ipsum\n")
+		self.assertEqual(payload.get_payload(decode=True), b"".join(mboxfilter.payload_chunks(payload, 4)))
+		# Base64 decoded as by the email package, stray characters and data after a padding included:
+		for encoded in ["QUJDRA==QUJD", "QUJD\nRA", "QU JD!R\nA=*=", "QUJDRA=", "QU=JD", "QUJD=QUJD", "QUJ=DRA==", "QUJDR", "Q===", ""]:
+			payload = email.message_from_string("Content-Transfer-Encoding: base64\n\n" + encoded)
+			for size in range(1, 10):
+				self.assertEqual(payload.get_payload(decode=True), b"".join(mboxfilter.payload_chunks(payload, size)))
+
+	def test_export_store(self):
+		output = output_dir("export_store")
+		fil = mboxfilter.Filter(output=output, filters=[("From", MAIL_1), ("To", MAIL_2)], selectors=[("Date", "%Y")], export_payload=True, export_store=True, quiet=True)
+		fil.filter_mbox(MBOX_1)
+		self.assertEqual((4, 4), (fil.exported, fil.stored))
+		rows = fil.db.execute('SELECT "Index", Filename, "SHA256-Value" FROM Attachments WHERE "Message-ID" = ? ORDER BY "Index"', ("mssgid-1",)).fetchall()
+		self.assertEqual(["test.txt", "test.png", "test.odt", "test.pdf"], [row[1] for row in rows])
+		for idx, fname, value in rows:
+			self.assertEqual(output + "/%s/%s/%s" %(value[0:2], value[2:4], value), fil.output_attachment_path(value))
+			self.assertEqual(file_read(fname), file_read(fil.output_attachment_path(value)))
+		# Payloads are decoded once, known ones are not stored again:
+		inodes = [os.stat(fil.output_attachment_path(row[2])).st_ino for row in rows]
+		fil = mboxfilter.Filter(output=output, export_payload=True, export_store=True, quiet=True)
+		decoded = []
+		decode = fil.output_attachment_decode
+		fil.output_attachment_decode = lambda handle, payload, hashing=False: decoded.append(payload) or decode(handle, payload, hashing)
+		fil.filter_mbox(MBOX_1)
+		self.assertEqual((4, 0), (fil.exported, fil.stored))
+		self.assertEqual(4, len(decoded))
+		self.assertEqual(inodes, [os.stat(fil.output_attachment_path(row[2])).st_ino for row in rows])
+		self.assertEqual(4, fil.db.execute("SELECT COUNT(*) FROM Attachments").fetchone()[0])
+		self.assertEqual([], [name for name in os.listdir(output) if name.endswith(".part")])
+
+	def test_payload_nested(self):
+		output = output_dir("payload_nested")
+		inner = email.mime.multipart.MIMEMultipart()
+		inner.attach(email.mime.text.MIMEText("inner"))
+		for name in ["a.txt", "b.txt"]:
+			part = email.mime.text.MIMEText(name)
+			part.add_header("Content-Disposition", "attachment", filename=name)
+			inner.attach(part)
+		mail = email.mime.multipart.MIMEMultipart()
+		mail["Message-ID"] = "<nested-1>"
+		mail.attach(email.mime.text.MIMEText("outer"))
+		mail.attach(inner)
+		part = email.mime.text.MIMEText("c.txt")
+		part.add_header("Content-Disposition", "attachment", filename="c.txt")
+		mail.attach(part)
+		fil = mboxfilter.Filter(output=output, export_payload=True, reduce_payload=True, quiet=True)
+		fil.payload_parse(mail)
+		self.assertEqual((6, 3, 3), (fil.visited, fil.exported, fil.deleted))
+		self.assertEqual(["nested-1.01.01.a.txt", "nested-1.01.02.b.txt", "nested-1.02.c.txt"], sorted(os.listdir(output)))
+		self.assertEqual(b"b.txt", file_read(output + "/nested-1.01.02.b.txt"))
+		self.assertEqual(2, len(mail.get_payload()))
+		self.assertEqual(["inner"], [payload.get_payload() for payload in mail.get_payload()[1].get_payload()])
+
+	def test_cache_spool(self):
+		fil_1 = mboxfilter.Filter(caching=True, filters=[("From", MAIL_1)], export_payload=True, selectors=[("To", None)], cache_budget=0, quiet=True)
+		fil_1.filter_mbox(MBOX_1)
+		fil_2 = mboxfilter.Filter(caching=True, filters=[("From", MAIL_1)], export_payload=True, selectors=[("To", None)], cache_budget=None, quiet=True)
+		fil_2.filter_mbox(MBOX_1)
+		self.assertEqual(0, fil_2.cache_statistics()["spool"]["spilled"])
+		self.assertEqual(len(fil_2.passed_mails) + len(fil_2.exported_payloads), fil_1.cache_statistics()["spool"]["spilled"])
+		self.assertEqual(fil_1.passed, len(fil_1.passed_mails))
+		self.assertEqual([str(mail) for mail in fil_2.passed_mails], [str(mail) for mail in fil_1.passed_mails])
+		self.assertEqual(list(fil_2.exported_payloads), list(fil_1.exported_payloads))
+		self.assertEqual(sorted(fil_2.resultset.keys()), sorted(fil_1.resultset.keys()))
+		for key in fil_2.resultset:
+			self.assertEqual([str(mail) for mail in fil_2.resultset[key]], [str(mail) for mail in fil_1.resultset[key]])
+		self.assertEqual(str(fil_1.passed_mails[-1]), str((fil_1.passed_mails + [])[-1]))
+		self.assertEqual([str(mail) for mail in fil_2.passed_mails] * 2, [str(mail) for mail in [] + fil_1.passed_mails + list(fil_2.passed_mails)])
+		# Closed spools give their memory back:
+		self.assertTrue(fil_2.spool_budget.used > 0)
+		fil_2.passed_mails.close()
+		fil_2.exported_payloads.close()
+		self.assertEqual(0, fil_2.spool_budget.used)
+		# Results are not shared between instances:
+		self.assertEqual(0, len(mboxfilter.Filter(caching=True).passed_mails))
+		fil_3 = mboxfilter.Filter(caching=True, filters=[("From", MAIL_1)], cache_budget=0, quiet=True)
+		fil_3.filter_mbox(fil_1.passed_mails)
+		self.assertEqual(fil_1.passed, fil_3.passed)
+
+	def test_pipeline(self):
+		fil_1 = mboxfilter.Filter(caching=True, filters=[("From", MAIL_1)], quiet=True)
+		fil_1.filter_mbox(MBOX_1)
+		fil_2 = mboxfilter.Filter(caching=True, filters=[("To", MAIL_1)], quiet=True)
+		fil_2.filter_mbox(MBOX_1)
+		md5_values = lambda mails: set(mboxfilter.mail_md5_value(mboxfilter.mail_decode(mail)) for mail in mails)
+		distinct = md5_values(fil_1.passed_mails + fil_2.passed_mails)
+		stage_1 = mboxfilter.Filter(filters=[("From", MAIL_1)], quiet=True)
+		stage_2 = mboxfilter.Filter(filters=[("To", MAIL_1)], quiet=True)
+		stage_3 = mboxfilter.Filter(caching=True, selectors=[("Date", "%Y")], quiet=True)
+		union = mboxfilter.Union(stage_1, stage_2)
+		mbox = mailbox.mbox(MBOX_1)
+		pipeline = mboxfilter.Pipeline(union, stage_3)
+		self.assertEqual(len(distinct), pipeline.filter_mbox(list(mbox) + list(mbox)))
+		self.assertTrue(union.duplicates >= len(distinct))
+		self.assertEqual(len(distinct), union.seen.added)
+		# A bare stage passes every mail:
+		self.assertEqual(2 * len(mbox), mboxfilter.Stage().filter_mbox(list(mbox) + list(mbox)))
+		self.assertEqual(distinct, md5_values(stage_3.resultset["2013"]))
+		# Intermediate stages don't output results:
+		self.assertEqual(0, len(stage_1.passed_mails) + len(stage_2.passed_mails))
+		fan_1 = mboxfilter.Filter(caching=True, filters=[("From", MAIL_1)], quiet=True)
+		fan_2 = mboxfilter.Filter(caching=True, filters=[("To", MAIL_1)], quiet=True)
+		fanout = mboxfilter.FanOut(fan_1, fan_2)
+		self.assertEqual(distinct, md5_values(mboxfilter.Pipeline(mboxfilter.Filter(quiet=True), fanout).filter_stream(MBOX_1)))
+		self.assertEqual(md5_values(fil_2.passed_mails), md5_values(fan_2.passed_mails))
+		# Only the last stage exports payloads:
+		output = output_dir("pipeline_export")
+		stage_1 = mboxfilter.Filter(export_payload=True, reduce_payload=True, payload_exportpath=output, quiet=True)
+		stage_2 = mboxfilter.Filter(output=output, filters=[("From", MAIL_1)], selectors=[("Date", "%Y")], export_payload=True, payload_exportpath=output, quiet=True)
+		self.assertEqual(2, mboxfilter.Pipeline(stage_1, stage_2).filter_mbox(MBOX_1))
+		self.assertEqual((0, 0, 4), (stage_1.exported, stage_1.deleted, stage_2.exported))
+		self.assertEqual(4, len([name for name in os.listdir(output) if name.startswith("mssgid-")]))
+
+	def test_filter_index(self):
+		output = output_dir("filter_index")
+		fil = mboxfilter.Filter(output=output, indexing=True, selectors=[("Date", "%Y")], quiet=True)
+		for mbox in [MBOX_1, MBOX_2, MBOX_3]:
+			fil.filter_mbox(mbox)
+		self.assertEqual(0, fil.db.execute("SELECT COUNT(*) FROM Mails WHERE Mbox IS NULL OR Timestamp IS NULL AND Date != ''").fetchone()[0])
+		self.assertEqual(2, len(fil.db.execute("SELECT * FROM Addresses WHERE Address = ? AND Header = 'From'", (MAIL_1.lower(),)).fetchall()))
+		for filters, or_logic in [([("From", MAIL_1)], False), ([("To", "@"), ("Date", "June 2013")], False), ([("Date", "2013", "2014")], False), ([("Date", "^T")], False), ([("From", MAIL_1), ("To", MAIL_1)], True)]:
+			scan = output_dir("filter_scan")
+			fil_1 = mboxfilter.Filter(output=scan, indexing=True, filters=filters, filter_or_logic=or_logic, selectors=[("From", None)], quiet=True)
+			for mbox in [MBOX_1, MBOX_2, MBOX_3]:
+				fil_1.filter_mbox(mbox)
+			fil_2 = mboxfilter.Filter(output=output, filters=filters, filter_or_logic=or_logic, selectors=[("From", None)], quiet=True)
+			self.assertEqual(fil_1.passed, fil_2.filter_index())
+			self.assertEqual(fil_1.passed, fil_2.passed)
+			self.assertTrue(fil_1.passed > 0)
+			for name in os.listdir(scan):
+				if name.endswith(".mbox"):
+					self.assertEqual(file_read(scan + "/" + name), file_read(output + "/" + name))
+					os.remove(output + "/" + name)
+		# Address filters are looked up by the index on addresses, years by the index on Timestamp:
+		for filters, index in [([("From", MAIL_1, "f")], "Addresses-Header"), ([("Date", "June 2013")], "Mails-Timestamp")]:
+			fil = mboxfilter.Filter(output=output, filters=filters, quiet=True)
+			fil.index_init()
+			where, args = fil.index_query()
+			plan = " ".join(row[-1] for row in fil.db.execute('EXPLAIN QUERY PLAN SELECT * FROM Mails m WHERE %s' %" AND ".join(where), args))
+			self.assertTrue(index in plan, plan)
+		plan = " ".join(row[-1] for row in fil.db.execute('EXPLAIN QUERY PLAN SELECT DISTINCT Address, Value FROM Addresses WHERE Header = ?', ("From",)))
+		self.assertTrue("Addresses-Header" in plan, plan)
+		fil = mboxfilter.Filter(output=output, filters=[("X-Spam", "yes")], quiet=True)
+		self.assertRaises(mboxfilter.HeaderNotIndexed, fil.filter_index)
+		# Both readers locate mails alike:
+		locations = []
+		for reader in mboxfilter.READERS:
+			fil = mboxfilter.Filter(output=output_dir("filter_index_%s" %reader), indexing=True, selectors=[("Date", "%Y")], reader=reader, quiet=True)
+			fil.filter_mbox(MBOX_1)
+			locations.append(fil.db.execute("SELECT Mbox, Offset, Length FROM Mails ORDER BY Offset").fetchall())
+		self.assertEqual(locations[0], locations[1])
+
+	def test_fulltext(self):
+		output = output_dir("fulltext")
+		fil = mboxfilter.Filter(output=output, fulltext=True, index_batch=2, selectors=[("Date", "%Y")], quiet=True)
+		self.assertTrue(fil.indexing)
+		for mbox in [MBOX_1, MBOX_2]:
+			fil.filter_mbox(mbox)
+		self.assertEqual(fil.db.execute("SELECT COUNT(*) FROM Mails").fetchone()[0], fil.db.execute("SELECT COUNT(*) FROM Fulltext").fetchone()[0])
+		mail = mailbox.mbox(MBOX_1)[0]
+		words = [word for word in re.findall("[a-zA-Z]{5,}", mail.get_payload()[0].get_payload()) if word != "From"]
+		found = list(fil.search(words[0]))
+		self.assertTrue(mail["Message-ID"] in [found_mail["Message-ID"] for found_mail in found])
+		fil = mboxfilter.Filter(output=output, filters=[("From", MAIL_1)], quiet=True)
+		passed = [found_mail["Message-ID"] for found_mail in fil.search(words[0])]
+		self.assertTrue(0 < len(passed) <= len(found))
+		fil = mboxfilter.Filter(output=output, filters=[("From", MAIL_1)], selectors=[("From", None)], quiet=True)
+		fil.filter_index(search=words[0])
+		self.assertEqual(len(passed), fil.passed)
+		self.assertEqual(len(passed), len(mailbox.mbox(output + "/" + MAIL_1 + ".mbox")))
+		self.assertEqual([], list(fil.search("nonexistingword")))
+		# Unknown charsets don't fail mails:
+		fil = mboxfilter.Filter(output=output_dir("fulltext_charset"), fulltext=True, selectors=[("Date", "%Y")], quiet=True)
+		mail = email.message_from_string("From: %s\nTo: %s\nDate: %s\nMessage-ID: <charset>\nContent-Type: text/plain; charset=x-bogus\n\nL\xf6rem" %(MAIL_1, MAIL_2, DATE_1))
+		fil.filter_mbox([mail])
+		self.assertEqual((1, 0), (fil.passed, fil.failed))
+		self.assertRaises(mboxfilter.FulltextUnavailable, list, mboxfilter.Filter(output=output_dir("fulltext_none"), indexing=True, quiet=True).search("lorem"))
+
+	def test_stats(self):
+		output = output_dir("stats")
+		fil = mboxfilter.Filter(output=output, selectors=[("Date", "%Y")], quiet=True)
+		self.assertFalse("filter_entry" in fil.__dict__)
+		self.assertFalse("stages" in fil.statistics())
+		fil = mboxfilter.Filter(output=output, filters=[("From", MAIL_1)], selectors=[("Date", "%Y")], archive=True, stats=True, quiet=True)
+		fil.filter_mbox(MBOX_1)
+		statistics = fil.statistics()
+		self.assertEqual(fil.filtered, statistics["stages"]["filter_entry"]["calls"])
+		self.assertEqual(fil.passed, statistics["stages"]["index_add"]["calls"])
+		self.assertEqual(os.path.getsize(MBOX_1), statistics["bytes_read"])
+		self.assertEqual(os.path.getsize(output + "/2013.mbox"), statistics["bytes_written"])
+		self.assertTrue(statistics["stages"]["filter_entry"]["wall"] >= statistics["stages"]["filter_mail_pass"]["wall"])
+		self.assertEqual(statistics, json.loads(json.dumps(statistics)))
+		fil = mboxfilter.Filter(output=output_dir("stats_parallel"), selectors=[("Date", "%Y")], jobs=2, chunk_size=1, stats=True, quiet=True)
+		fil.filter_mbox(MBOX_1)
+		statistics = fil.statistics()
+		self.assertEqual(fil.filtered, statistics["stages"]["filter_entry"]["calls"])
+		self.assertEqual(os.path.getsize(MBOX_1), statistics["bytes_read"])
+
+	def test_date_engine(self):
+		for value in [DATE_1, DATE_3, "Fri, 21 Jun 2013 12:15:00 +0200 (CEST)", "21 Jun 2013 12:15 -0000", "Fri, 1 Jun 13 12:15:00 +0200", "Fri, 21 Jun 2013 12:15:00 GMT", "invalid"]:
+			self.assertEqual(email.utils.parsedate_tz(value), mboxfilter.date_parse_tz(value))
+		mboxfilter.date_format_cache.clear()
+		for i in range(3):
+			self.assertEqual("2013-06", mboxfilter.header_format("Date", DATE_1, "%Y-%m"))
+		self.assertEqual({"hits": 2, "misses": 1}, dict((key, value) for key, value in mboxfilter.date_format_cache.statistics().items() if key in ("hits", "misses")))
+		self.assertEqual(mboxfilter.date_timestamp("2013-06-25T15:41:49+00:00"), mboxfilter.header_timestamp(DATE_3))
+		self.assertEqual(mboxfilter.date_timestamp("2013-06-25"), mboxfilter.date_timestamp(datetime.date(2013, 6, 25)))
+		self.assertRaises(mboxfilter.DateInvalid, mboxfilter.date_timestamp, "25.06.2013")
+		# 18:41:49 +0300 is 15:41:49 UTC:
+		fil_1 = mboxfilter.Filter(caching=True, since="2013-06-25T15:41:49+00:00", quiet=True)
+		fil_1.filter_mbox(MBOX_1)
+		fil_2 = mboxfilter.Filter(caching=True, until="Tue, 25 Jun 2013 17:41:49 +0200", quiet=True)
+		fil_2.filter_mbox(MBOX_1)
+		self.assertEqual([MSGID_3, MSGID_4, MSGID_5, MSGID_5], [email.utils.unquote(mail["Message-ID"]) for mail in fil_1.passed_mails])
+		self.assertEqual([MSGID_1, MSGID_2], [email.utils.unquote(mail["Message-ID"]) for mail in fil_2.passed_mails])
+		self.assertEqual(1, fil_1.failed)
+
+	def test_sort_keys(self):
+		mail = email.message_from_string("From: a@example.org\nTo: b@example.org, c@example.org, b@example.org\nCc: d@example.org\nSubject: keys\n\nbody\n")
+		fil_1 = mboxfilter.Filter(output=DIR, selectors=[("From", None), ("To", None)], quiet=True)
+		serialized = []
+		mail_serialize = fil_1.mail_serialize
+		fil_1.mail_serialize = lambda mail: serialized.append(mail) or mail_serialize(mail)
+		self.assertTrue(fil_1.filter_mail(mail))
+		fil_1.close()
+		# Duplicate key parts are dropped:
+		self.assertEqual([("a@example.org", "b@example.org"), ("a@example.org", "c@example.org")], fil_1.sort_keys)
+		self.assertEqual(1, len(serialized))
+		self.assertEqual(file_read(DIR + "/a@example.org.b@example.org.mbox"), file_read(DIR + "/a@example.org.c@example.org.mbox"))
+		fil_2 = mboxfilter.Filter(caching=True, selectors=[("From", None), ("To", None)], max_keys=1, quiet=True)
+		self.assertFalse(fil_2.filter_mail(mail))
+		self.assertEqual((1, 1), (fil_2.failed, fil_2.exceeded))
+		self.assertEqual(1, fil_2.statistics()["exceeded"])
+
+	def test_passthrough(self):
+		mbox = mboxfilter.MmapMbox(MBOX_1)
+		# The mail without Date fails:
+		raw = b"".join(entry.raw() for entry in mbox if entry.headers()["Date"])
+		mbox.close()
+		results = []
+		for name, options in [("mmap", {"reader": "mmap"}), ("mailbox", {}), ("jobs", {"jobs": 2, "chunk_size": 100})]:
+			output = output_dir(name)
+			fil = mboxfilter.Filter(output=output, selectors=[("Date", "%Y")], quiet=True, **options)
+			fil.filter_mbox(MBOX_1)
+			fil.close()
+			results.append(file_read(output + "/2013.mbox"))
+		self.assertEqual([raw] * 3, results)
+		# Copied in the kernel:
+		copy_min, mboxfilter.COPY_MIN = mboxfilter.COPY_MIN, 0
+		try:
+			fil = mboxfilter.Filter(output=output_dir("copy"), selectors=[("Date", "%Y")], reader="mmap", quiet=True)
+			fil.filter_mbox(MBOX_1)
+			fil.close()
+		finally:
+			mboxfilter.COPY_MIN = copy_min
+		self.assertEqual(raw, file_read(DIR + "/copy/2013.mbox"))
+		# Mails with removed payloads are serialized:
+		fil = mboxfilter.Filter(output=output_dir("reduce"), selectors=[("Date", "%Y")], reduce_payload=True, quiet=True)
+		fil.filter_mbox(MBOX_1)
+		fil.close()
+		reduced = mailbox.mbox(DIR + "/reduce/2013.mbox")
+		self.assertEqual(1, len(reduced[0].get_payload()))
+		# The other mails are written raw:
+		self.assertTrue(file_read(DIR + "/reduce/2013.mbox").endswith(raw[raw.find(b"\nFrom ") + 1:]))
+
+	def test_writer(self):
+		results = []
+		for name, writers in [("writer_0", 0), ("writer_3", 3)]:
+			output = output_dir(name)
+			fil = mboxfilter.Filter(output=output, archive=True, selectors=[("From", None), ("To", None)], export_payload=True, payload_exportpath=output, writers=writers, write_queue=2, quiet=True)
+			fil.filter_mbox(MBOX_1)
+			fil.filter_mbox(MBOX_1)
+			mails = fil.db.execute('SELECT "MD5-Value", Offset FROM Mails ORDER BY Offset').fetchall()
+			results.append(((fil.passed, fil.failed, fil.exported), mails, dict((path, file_read(output + "/" + path)) for path in os.listdir(output) if not path.startswith("index"))))
+		self.assertEqual(results[0], results[1])
+		self.assertEqual(3, fil.statistics()["writer"]["threads"])
+		self.assertEqual([], fil.writer.threads)
+		# Failed writes fail their mails:
+		output = output_dir("writer_failed")
+		os.mkdir(output + "/2013.mbox")
+		fil = mboxfilter.Filter(output=output, selectors=[("Date", "%Y")], writers=2, quiet=True)
+		fil.filter_mbox(MBOX_1)
+		self.assertEqual((0, 7), (fil.passed, fil.failed))
+		# A mail fails once, counted as passed or not:
+		fil = mboxfilter.Filter(output=output, selectors=[("Date", "%Y")], writers=1, quiet=True)
+		fil.mail_start()
+		fil.writer.failures.append((fil.mail_seq, "failed", None))
+		fil.writer_failures()
+		fil.mail_passed()
+		fil.mail_start()
+		fil.mail_passed()
+		fil.writer.failures.extend([(fil.mail_seq - 1, "failed", None), (fil.mail_seq, "failed", None), (fil.mail_seq, "failed", None)])
+		fil.writer_join()
+		self.assertEqual((0, 2), (fil.passed, fil.failed))
+
+	def test_compressed(self):
+		raw = file_read(MBOX_1)
+		mbox = mboxfilter.MmapMbox(MBOX_1)
+		members = b"".join(gzip.compress(entry.raw()) for entry in mbox)
+		mbox.close()
+		for name, content in [("mbox.gz", gzip.compress(raw)), ("mbox.bz2", bz2.compress(raw)), ("mbox.xz", lzma.compress(raw)), ("members.gz", members)]:
+			with open(DIR + "/" + name, "wb") as handle:
+				handle.write(content)
+		def message_ids(path, **options):
+			fil = mboxfilter.Filter(caching=True, filters=[("From", MAIL_1)], quiet=True, **options)
+			fil.filter_mbox(path)
+			return [mail["Message-ID"] for mail in fil.passed_mails]
+		expected = message_ids(MBOX_1)
+		self.assertEqual(2, len(expected))
+		for name in ["mbox.gz", "mbox.bz2", "mbox.xz", "members.gz"]:
+			self.assertEqual(expected, message_ids(DIR + "/" + name))
+		# Members decompressed by worker processes:
+		self.assertEqual(expected, message_ids(DIR + "/members.gz", jobs=2, chunk_size=100))
+		self.assertEqual(expected, message_ids(DIR + "/mbox.gz", jobs=2, chunk_size=100))
+		self.assertEqual(raw, b"".join(mboxfilter.gzip_blocks(DIR + "/members.gz", 2, 100)))
+		# A single member is streamed without worker processes:
+		pool = mboxfilter.multiprocessing.Pool
+		mboxfilter.multiprocessing.Pool = None
+		try:
+			self.assertEqual(raw, b"".join(mboxfilter.gzip_blocks(DIR + "/mbox.gz", 2, 100)))
+		finally:
+			mboxfilter.multiprocessing.Pool = pool
+		# Mails are written by their raw bytes:
+		output = output_dir("compressed")
+		fil = mboxfilter.Filter(output=output, selectors=[("Date", "%Y")], quiet=True)
+		fil.filter_mbox(DIR + "/mbox.xz")
+		fil.close()
+		self.assertEqual(6, len(mailbox.mbox(output + "/2013.mbox")))
+
+	def test_compressed_output(self):
+		output = output_dir("plain")
+		fil = mboxfilter.Filter(output=output, selectors=[("Date", "%Y")], quiet=True)
+		fil.filter_mbox(MBOX_1)
+		fil.close()
+		plain = file_read(output + "/2013.mbox")
+		for name, writers in [("gzip_0", 0), ("gzip_2", 2)]:
+			output = output_dir(name)
+			# A stream per run:
+			for run in range(2):
+				fil = mboxfilter.Filter(output=output, selectors=[("Date", "%Y")], export_payload=True, payload_exportpath=output, compression="gzip", writers=writers, max_open=1, quiet=True)
+				fil.filter_mbox(MBOX_1)
+				fil.close()
+				self.assertEqual(1, fil.failed)
+			self.assertEqual(2 * plain, gzip.decompress(file_read(output + "/2013.mbox.gz")))
+			# Text payloads only:
+			self.assertEqual(file_read("test.txt"), gzip.decompress(file_read(output + "/mssgid-1.01.test.txt.gz")))
+			self.assertEqual(file_read("test.png"), file_read(output + "/mssgid-1.02.test.png"))
+		self.assertRaises(mboxfilter.CompressionUnavailable, mboxfilter.Filter, compression="zip")
+
+	def test_dedup(self):
+		results = []
+		for dedup in [False, "set", "bloom"]:
+			output = output_dir("dedup_%s" %dedup)
+			fil = mboxfilter.Filter(output=output, archive=True, dedup=dedup, quiet=True)
+			fil.filter_mbox(MBOX_1)
+			fil.filter_mbox(MBOX_1)
+			fil.close()
+			mails = fil.db.execute('SELECT "MD5-Value", Offset FROM Mails ORDER BY Offset').fetchall()
+			results.append(((fil.passed, fil.failed), mails, file_read(output + "/2013.mbox")))
+		self.assertEqual(results[0], results[1])
+		self.assertEqual(results[0], results[2])
+		# Digests are preloaded from the index:
+		fil = mboxfilter.Filter(output=output, indexing=True, dedup="set", quiet=True)
+		self.assertEqual(len(results[0][1]), fil.statistics()["dedup"]["digests"])
+		fil.filter_mbox(MBOX_1)
+		self.assertEqual(0, fil.passed)
+		self.assertEqual(fil.failed, fil.statistics()["dedup"]["duplicates"])
+		# Rows without digest get their binary MD5 value:
+		fil.db.execute("UPDATE Mails SET Digest = NULL")
+		fil.db.commit()
+		fil = mboxfilter.Filter(output=output, indexing=True, quiet=True)
+		self.assertEqual(0, fil.db.execute("SELECT COUNT(*) FROM Mails WHERE Digest IS NULL").fetchone()[0])
+		self.assertEqual(len(results[0][1]), fil.statistics()["dedup"]["digests"])
+		fil.filter_mbox(MBOX_1)
+		self.assertEqual(0, fil.passed)
+		md5, digest = fil.db.execute('SELECT "MD5-Value", Digest FROM Mails').fetchone()
+		self.assertEqual(md5, binascii.hexlify(digest).decode("ascii"))
+		# Without index, duplicates fail as such:
+		fil = mboxfilter.Filter(caching=True, dedup="set", quiet=True)
+		messages = []
+		fil.error = lambda msg, mail: messages.append(msg)
+		fil.filter_mbox(MBOX_1)
+		self.assertEqual("mail passed before: ", messages[0][:20])
+		# Without index, also by worker processes:
+		for jobs in [1, 2]:
+			output = output_dir("dedup_jobs_%s" %jobs)
+			fil = mboxfilter.Filter(output=output, selectors=[("Date", "%Y")], dedup="bloom", jobs=jobs, chunk_size=100, quiet=True)
+			fil.filter_mbox(MBOX_1)
+			fil.filter_mbox(MBOX_1)
+			fil.close()
+			self.assertEqual(results[0][0], (fil.passed, fil.failed))
+			self.assertEqual(results[0][2], file_read(output + "/2013.mbox"))
+			self.assertFalse(os.path.exists(output + "/index.sqlite3"))
+		# A Bloom filter tells new digests for sure only:
+		dedup = mboxfilter.Dedup(100, False)
+		digests = [mboxfilter.mail_digest(lambda header, idx=idx: "%s %s" %(header, idx)) for idx in range(200)]
+		for digest in digests[:100]:
+			dedup.add(digest)
+		self.assertEqual([None] * 100, [dedup.seen(digest) for digest in digests[:100]])
+		self.assertTrue(90 < [dedup.seen(digest) for digest in digests[100:]].count(False))
+		# A full Bloom filter grows, its error stays about 1%:
+		dedup = mboxfilter.Dedup(100, False)
+		digests = [mboxfilter.mail_digest(lambda header, idx=idx: "%s %s" %(header, idx)) for idx in range(20000)]
+		for digest in digests[:10000]:
+			dedup.add(digest)
+		self.assertEqual(7, dedup.statistics()["filters"])
+		self.assertEqual([None] * 10000, [dedup.seen(digest) for digest in digests[:10000]])
+		self.assertTrue(200 > [dedup.seen(digest) for digest in digests[10000:]].count(None))
+		# Without indexing a Bloom filter has no exact check, digests are kept in a set:
+		self.assertTrue(mboxfilter.Filter(caching=True, dedup="bloom", quiet=True).dedup.exact)
+		self.assertRaises(mboxfilter.DedupUnknown, mboxfilter.Filter, dedup="hash")
+
 	"""  
 	def test_subject_sort(self):
 		fil = MboxFilterOutput(selectors=[("Subject", None)])
@@ -271,6 +901,13 @@ class TestMboxFilter(unittest.TestCase):
 		""" Encode a header value in ISO-8859-1 """
 		return email.header.Header(", ".join(headers), 'iso-8859-1')
 
+def output_dir(name):
+	""" Create an empty output directory below DIR """
+	path = DIR + "/" + name
+	shutil.rmtree(path, True)
+	os.mkdir(path)
+	return path
+
 def file_read(path):
 	with open(path, "rb") as fd:
 		return fd.read()
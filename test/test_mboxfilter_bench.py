@@ -0,0 +1,40 @@
+# -*- coding: UTF-8 -*-
+import mailbox
+import mboxfilter_bench
+import os
+import shutil
+import unittest
+
+DIR = 'unit-tests-bench'
+
+class TestMboxFilterBench(unittest.TestCase):
+	def setUp(self):
+		shutil.rmtree(DIR, True)
+		os.mkdir(DIR)
+
+	def tearDown(self):
+		shutil.rmtree(DIR, True)
+
+	def test_generate_mbox(self):
+		mboxfilter_bench.generate_mbox(DIR + "/a", count=20, attachment_size=100, attachments=0.5, seed=3)
+		mboxfilter_bench.generate_mbox(DIR + "/b", count=20, attachment_size=100, attachments=0.5, seed=3)
+		self.assertEqual(file_read(DIR + "/a"), file_read(DIR + "/b"))
+		m = mailbox.mbox(DIR + "/a")
+		self.assertEqual(20, len(m))
+		self.assertTrue(any([mail.is_multipart() for mail in m]))
+
+	def test_measure_scenario(self):
+		path = mboxfilter_bench.generate_mbox(DIR + "/mbox", count=20, attachment_size=100, attachments=0.5)
+		for name in sorted(mboxfilter_bench.SCENARIOS.keys()):
+			result = mboxfilter_bench.measure_scenario(name, path, DIR)
+			self.assertEqual(name, result["scenario"])
+			self.assertEqual(20, result["mails"])
+			self.assertEqual(0, result["failed"])
+			self.assertTrue(result["peak_rss_kb"] > 0)
+
+def file_read(path):
+	with open(path, "rb") as fd:
+		return fd.read()
+
+if __name__ == '__main__':
+	unittest.main()